@@ -1,4 +1,5 @@
 import SimpleITK as sitk
+import numpy as np
 from enum import Enum
 
 ##########################
@@ -72,6 +73,22 @@ class DataType:
 
     LabelUInt64 = sitk.sitkLabelUInt64
 
+numpy_dtypes = {
+    DataType.Uint8: np.uint8, DataType.Int8: np.int8,
+    DataType.UInt16: np.uint16, DataType.Int16: np.int16,
+    DataType.UInt32: np.uint32, DataType.Int32: np.int32,
+    DataType.UInt64: np.uint64, DataType.Int64: np.int64,
+    DataType.Float32: np.float32, DataType.Float64: np.float64,
+    DataType.ComplexFloat32: np.complex64, DataType.ComplexFloat64: np.complex128,
+    DataType.VectorUInt8: np.uint8, DataType.VectorInt8: np.int8,
+    DataType.VectorUInt16: np.uint16, DataType.VectorInt16: np.int16,
+    DataType.VectorUInt32: np.uint32, DataType.VectorInt32: np.int32,
+    DataType.VectorUInt64: np.uint64, DataType.VectorInt64: np.int64,
+    DataType.VectorFloat32: np.float32, DataType.VectorFloat64: np.float64,
+    DataType.LabelUInt8: np.uint8, DataType.LabelUInt16: np.uint16,
+    DataType.LabelUInt32: np.uint32, DataType.LabelUInt64: np.uint64,
+}
+
 ##########################
 ###   Interpolator Type     
 ##########################
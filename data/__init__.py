@@ -1,2 +1,5 @@
 from .image import Image, Subject
-from .io import imread, imsave
\ No newline at end of file
+from .io import imread, imread_series, imsave
+from .dataset import SubjectDataset, collate
+from .sampler import UniformSampler, LabelSampler, ForegroundSampler, PatchQueue
+from .inference import GridSampler, PatchAggregator, sliding_window_inference
\ No newline at end of file
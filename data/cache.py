@@ -0,0 +1,80 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable
+import SimpleITK as sitk
+import numpy as np
+
+from config import numpy_dtypes
+
+
+def image_nbytes(image:sitk.Image) -> int:
+    itemsize = np.dtype(numpy_dtypes[image.GetPixelID()]).itemsize
+    return int(np.prod(image.GetSize())) * image.GetNumberOfComponentsPerPixel() * itemsize
+
+
+class ImageCache:
+    '''
+        Process-wide LRU cache of read images, bounded by `max_bytes`. Images are handed out as
+        SimpleITK copy-on-write copies, so callers modifying them never change the cached image.
+    '''
+    def __init__(self, max_bytes:int=2**32) -> None:
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(image_path:str, *args) -> Hashable:
+        # a rewritten file gets a new key, its stale entry ages out
+        stat = os.stat(image_path)
+        return (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size) + tuple(
+            tuple(map(tuple, arg)) if isinstance(arg, (tuple, list)) else arg for arg in args
+        )
+
+    def get(self, key:Hashable, read:Callable[[], sitk.Image]) -> sitk.Image:
+        with self.lock:
+            if key in self.images:
+                self.hits += 1
+                self.images.move_to_end(key)
+                return sitk.Image(self.images[key])
+            self.misses += 1
+
+        image = read()
+        if image is None:
+            return image
+        nbytes = image_nbytes(image)
+        if nbytes > self.max_bytes:
+            return image
+
+        with self.lock:
+            if key not in self.images:
+                self.images[key] = sitk.Image(image)
+                self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.nbytes -= image_nbytes(evicted)
+                self.evictions += 1
+        return image
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.images),
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def __len__(self):
+        return len(self.images)
@@ -0,0 +1,191 @@
+import os
+import json
+import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from typing import Sequence, Tuple, Union
+import numpy as np
+
+extension = '.mxv'
+HEADER = 'header.json'
+RAW = 'volume.raw'
+CHUNKS = 'chunks'
+
+
+def is_chunked(path:str) -> bool:
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, HEADER))
+
+
+def _codec(compression:str):
+    if compression == 'zlib':
+        return (lambda data, level: zlib.compress(data, level)), zlib.decompress
+    elif compression == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError("lz4 compression requires the lz4 package!")
+        return (lambda data, level: lz4.frame.compress(data, compression_level=level)), lz4.frame.decompress
+    raise ValueError(f"Unknown compression: {compression}!")
+
+
+def _chunk_name(index:Sequence[int]):
+    return '.'.join(str(i) for i in index)
+
+
+class ChunkedWriter:
+    '''
+        Writes a chunked volume of `shape` (D H W [C]) slab by slab along the first axis, so
+        it never has to be in memory as a whole. With compression, every slab but the last
+        must start and end on a chunk boundary. The volume is complete once `close` has
+        written its header.
+    '''
+    def __init__(
+        self,
+        path:str,
+        shape:Sequence[int],
+        dtype:np.dtype,
+        info:dict,
+        chunks:Sequence[int] = (64, 64, 64),
+        compression:str = None,
+        level:int = 1,
+        workers:int = None
+    ) -> None:
+        if os.path.isdir(path):
+            if not is_chunked(path):
+                raise ValueError(f"{path} exists and is not a chunked volume!")
+            shutil.rmtree(path)
+        os.makedirs(path)
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self.level = level
+        self.workers = workers
+        self.header = dict(info, shape=list(self.shape), dtype=self.dtype.str, compression=compression, chunks=None)
+        if compression is None:
+            self.raw = np.memmap(os.path.join(path, RAW), self.dtype, 'w+', shape=self.shape)
+        else:
+            self.compress, _ = _codec(compression)
+            self.chunks = tuple(chunks[:len(self.shape)]) + self.shape[len(chunks):] # channels are not chunked
+            self.header['chunks'] = list(self.chunks)
+            os.makedirs(os.path.join(path, CHUNKS))
+
+    def write(self, start:int, array:np.ndarray):
+        '''
+            Writes `array` at index `start` of the first axis.
+        '''
+        if self.compression is None:
+            self.raw[start:start + len(array)] = array
+            return
+        if start % self.chunks[0] or (len(array) % self.chunks[0] and start + len(array) != self.shape[0]):
+            raise ValueError("Compressed slabs must be aligned to the chunks!")
+        grid = [range(start, start + len(array), self.chunks[0])] + [
+            range(0, n, c) for n, c in zip(self.shape[1:], self.chunks[1:])
+        ]
+
+        def write(corner:Tuple[int]):
+            box = (slice(corner[0] - start, corner[0] - start + self.chunks[0]),) + tuple(
+                slice(s, s + c) for s, c in zip(corner[1:], self.chunks[1:])
+            )
+            data = self.compress(np.ascontiguousarray(array[box]).tobytes(), self.level)
+            name = _chunk_name(s // c for s, c in zip(corner, self.chunks))
+            with open(os.path.join(self.path, CHUNKS, name), 'wb') as f:
+                f.write(data)
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            list(executor.map(write, product(*grid)))
+
+    def close(self):
+        if self.compression is None:
+            self.raw.flush()
+            del self.raw
+        # the header is written last, a volume without it is incomplete
+        with open(os.path.join(self.path, HEADER), 'w') as f:
+            json.dump(self.header, f)
+
+
+def write_chunked(
+    path:str,
+    array:np.ndarray,
+    info:dict,
+    chunks:Sequence[int] = (64, 64, 64),
+    compression:str = None,
+    level:int = 1,
+    workers:int = None
+):
+    '''
+        Writes `array` (D H W [C]) and the geometry in `info` as a chunked volume directory.
+        Without compression the voxels are stored as one raw C-order file that can be memory-mapped,
+        otherwise every chunk is compressed on its own so that it can be read independently.
+    '''
+    writer = ChunkedWriter(path, array.shape, array.dtype, info, chunks, compression, level, workers)
+    writer.write(0, array)
+    writer.close()
+
+
+class ChunkedVolume:
+    def __init__(self, path:str, workers:int = None) -> None:
+        with open(os.path.join(path, HEADER)) as f:
+            self.header = json.load(f)
+        self.path = path
+        self.workers = workers
+        self.shape = tuple(self.header['shape'])
+        self.dtype = np.dtype(self.header['dtype'])
+        self.chunks = self.header['chunks']
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def memmap(self) -> np.memmap:
+        if self.header['compression'] is not None:
+            raise ValueError("Only uncompressed volumes can be memory-mapped!")
+        return np.memmap(os.path.join(self.path, RAW), self.dtype, 'r', shape=self.shape)
+
+    def read(self, start:Sequence[int] = None, stop:Sequence[int] = None) -> np.ndarray:
+        '''
+            Reads the box [start, stop) (numpy axis order). Uncompressed volumes return a read-only
+            memory-mapped view, compressed ones only decode the chunks overlapping the box.
+        '''
+        start = tuple(start if start is not None else ())
+        start = start + (0,) * (self.ndim - len(start))
+        stop = tuple(stop if stop is not None else ())
+        stop = stop + self.shape[len(stop):]
+        if self.header['compression'] is None:
+            return self.memmap()[tuple(slice(s, e) for s, e in zip(start, stop))]
+
+        _, decompress = _codec(self.header['compression'])
+        out = np.empty([e - s for s, e in zip(start, stop)], self.dtype)
+        grid = [range(s // c, (e - 1) // c + 1) for s, e, c in zip(start, stop, self.chunks)]
+
+        def read(index:Tuple[int]):
+            lower = [i * c for i, c in zip(index, self.chunks)]
+            upper = [min(l + c, n) for l, c, n in zip(lower, self.chunks, self.shape)]
+            with open(os.path.join(self.path, CHUNKS, _chunk_name(index)), 'rb') as f:
+                chunk = np.frombuffer(decompress(f.read()), self.dtype).reshape([u - l for l, u in zip(lower, upper)])
+            src = tuple(slice(max(s, l) - l, min(e, u) - l) for s, e, l, u in zip(start, stop, lower, upper))
+            dst = tuple(slice(max(s, l) - s, min(e, u) - s) for s, e, l, u in zip(start, stop, lower, upper))
+            out[dst] = chunk[src]
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            list(executor.map(read, product(*grid)))
+        return out
+
+    def __getitem__(self, index:Union[int, slice, Tuple[Union[int, slice]]]) -> np.ndarray:
+        index = index if isinstance(index, tuple) else (index,)
+        start, stop, post = [], [], []
+        for key, n in zip(index, self.shape):
+            if isinstance(key, slice):
+                s, e, step = key.indices(n)
+                if step < 0:
+                    raise IndexError("Negative steps are not supported!")
+                start.append(s); stop.append(max(s, e)); post.append(slice(None, None, step))
+            else:
+                key = key + n if key < 0 else key
+                start.append(key); stop.append(key + 1); post.append(0)
+        return self.read(start, stop)[tuple(post)]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.read()
+        return array if dtype is None else array.astype(dtype)
@@ -0,0 +1,113 @@
+from typing import Callable, List, Sequence, Union
+import SimpleITK as sitk
+import numpy as np
+import torch
+from torch.utils.data import Dataset, get_worker_info
+
+from .image import Image, Subject
+from config import ImageType
+
+
+def empty_tensor(shape:Sequence[int], dtype:torch.dtype, shared:bool=None) -> torch.Tensor:
+    '''
+        Allocates a tensor, in shared memory when `shared` (by default inside DataLoader workers),
+        so sending it to the main process doesn't copy it again.
+    '''
+    shared = get_worker_info() is not None if shared is None else shared
+    if not shared:
+        return torch.empty(shape, dtype=dtype)
+    # same allocation as torch's default_collate in workers
+    elem = torch.empty(0, dtype=dtype)
+    storage = elem._typed_storage()._new_shared(int(np.prod(shape)))
+    return elem.new(storage).resize_(tuple(shape))
+
+
+def image_to_tensor(image:Union[Image, sitk.Image], shared:bool=None) -> torch.Tensor:
+    '''
+        Copies the voxels once into a channel-first (C D H W) tensor.
+    '''
+    if not isinstance(image, Image):
+        image = Image(image)
+    return array_to_tensor(image.view, image.GetNumberOfComponentsPerPixel() > 1, shared)
+
+
+def array_to_tensor(array:np.ndarray, is_vector:bool=False, shared:bool=None) -> torch.Tensor:
+    array = np.moveaxis(array, -1, 0) if is_vector else array[np.newaxis, ...]
+    dtype = torch.from_numpy(np.empty(0, array.dtype)).dtype
+    tensor = empty_tensor(array.shape, dtype, shared)
+    tensor.numpy()[...] = array
+    return tensor
+
+
+class SubjectDataset(Dataset):
+    '''
+        Dataset over a manifest of subjects. Every item is either a `Subject` or a dict whose
+        string values are image paths, read inside the DataLoader worker. Images of the
+        (transformed) subject are returned as C D H W tensors, other values as they are.
+    '''
+    def __init__(
+        self,
+        subjects:Sequence[Union[Subject, dict]],
+        transform:Callable = None,
+        label_keys:Sequence[str] = (),
+        shared_memory:bool = False
+    ) -> None:
+        self.subjects = subjects
+        self.transform = transform
+        self.label_keys = tuple(label_keys)
+        self.shared_memory = shared_memory
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def load(self, index:int) -> Subject:
+        item = self.subjects[index]
+        if isinstance(item, Subject):
+            return item.clone()
+        return Subject(**{
+            name: Image(value, type=ImageType.Label if name in self.label_keys else ImageType.Scalar)
+            if isinstance(value, str) else value for name, value in item.items()
+        })
+
+    def subject(self, index:int) -> Subject:
+        subject = self.load(index)
+        if self.transform is not None:
+            subject = self.transform(subject)
+        return subject
+
+    def __getitem__(self, index:int) -> dict:
+        subject = self.subject(index)
+        # only a sample sent without collation (batch_size=None) needs shared memory of its own
+        shared = self.shared_memory and get_worker_info() is not None
+        images = subject.images
+        return {
+            name: image_to_tensor(value, shared) if name in images else value
+            for name, value in subject.items()
+        }
+
+
+def collate(batch:List[dict], pad:bool=False, pad_value:float=0) -> dict:
+    '''
+        Stacks the tensors of a list of samples. Tensors of different sizes are padded at the
+        end of every axis when `pad` is True, and their original shapes are returned in 'shapes'.
+        Use `functools.partial(collate, pad=True)` as a DataLoader `collate_fn`.
+    '''
+    out, shapes = {}, {}
+    for name in batch[0]:
+        values = [sample[name] for sample in batch]
+        if not isinstance(values[0], torch.Tensor):
+            out[name] = values
+            continue
+        sizes = np.asarray([value.shape for value in values])
+        if not pad and np.any(sizes != sizes[0]):
+            raise ValueError(f"Tensors of {name} have different shapes, use pad=True to pad them!")
+        tensor = empty_tensor((len(values),) + tuple(sizes.max(axis=0)), values[0].dtype)
+        if np.any(sizes != sizes[0]):
+            tensor.fill_(pad_value)
+            shapes[name] = torch.from_numpy(sizes)
+        for i, value in enumerate(values):
+            tensor[(i,) + tuple(slice(0, s) for s in value.shape)] = value
+        out[name] = tensor
+    if shapes:
+        out['shapes'] = shapes
+    return out
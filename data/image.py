@@ -1,24 +1,71 @@
 import os
-from typing import List, Sequence, Union
+from functools import wraps
+from typing import List, Sequence, Tuple, Union
 import SimpleITK as sitk
 import numpy as np
 from torch import from_numpy
 
 from . import io
-from config import ImageType
+from config import ImageType, numpy_dtypes
+
+
+class _ImageBuffer:
+    # exposes a voxel view through the array interface while keeping its image alive
+    def __init__(self, image:sitk.Image, view:np.ndarray, writable:bool=False) -> None:
+        self.image = image
+        self.__array_interface__ = view.__array_interface__
+        if writable:
+            self.__array_interface__ = dict(
+                self.__array_interface__, data=(self.__array_interface__['data'][0], False)
+            )
+
+
+def _modifies_buffer(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.invalidate()
+        return self if isinstance(result, sitk.Image) else result
+    return wrapper
+
+
+def _from_header(method, read):
+    @wraps(method)
+    def getter(self, *args):
+        return method(self, *args) if self.is_loaded else read(self._header, *args)
+    return getter
+
+
+def _to_header(method, key):
+    @wraps(method)
+    def setter(self, value):
+        if self.is_loaded: method(self, value)
+        else: self._header[key] = tuple(value)
+    return setter
+
 
 class Image(sitk.Image):
+    _view = None
+    _header = None
+
     def __init__(
         self,
-        image: Union[str, List[str], sitk.Image, np.ndarray],
+        image: Union[str, List[str], sitk.Image, np.ndarray, dict],
         orientation: str = 'LPS',
         type: str = ImageType.Scalar,
-        is_vector: bool = None
+        is_vector: bool = None,
+        lazy: bool = False,
+        region: Tuple[Sequence[float], Sequence[float]] = None,
+        physical: bool = False
     ) -> None:
         try:
             if isinstance(image, sitk.Image): super().__init__(image)
             elif isinstance(image, np.ndarray): super().__init__(sitk.GetImageFromArray(image, is_vector))
-            else: super().__init__(io.imread(image, orientation))
+            elif isinstance(image, dict): self._header = dict(image)
+            elif (lazy or io.is_chunked(image)) and isinstance(image, str): self._header = io.imread_header(image, orientation, region=region, physical=physical)
+            else: super().__init__(io.imread(image, orientation, region=region, physical=physical))
+        except ValueError:
+            raise
         except:
             raise ValueError("Input must be a SimpleITK Image, a file path or a list of file paths!")
         
@@ -26,8 +73,98 @@ class Image(sitk.Image):
         self.channels = self.GetNumberOfComponentsPerPixel()
 
     @property
-    def array(self):
-        return sitk.GetArrayFromImage(self)
+    def this(self):
+        # SWIG resolves the wrapped itk image through `this`, so any SimpleITK call loads a lazy image
+        if 'this' not in self.__dict__:
+            if self._header is None:
+                raise AttributeError('this')
+            self.load()
+        return self.__dict__['this']
+
+    @this.setter
+    def this(self, this):
+        self.__dict__['this'] = this
+
+    @property
+    def is_loaded(self) -> bool:
+        return 'this' in self.__dict__
+
+    def load(self):
+        if not self.is_loaded:
+            image = io.imread_from_header(self._header)
+            image.SetSpacing(self._header['spacing'])
+            image.SetOrigin(self._header['origin'])
+            image.SetDirection(self._header['direction'])
+            self.this = image.this
+            self._header = None
+            self.invalidate()
+        return self
+
+    GetSize = _from_header(sitk.Image.GetSize, lambda header: tuple(header['size']))
+    GetWidth = _from_header(sitk.Image.GetWidth, lambda header: header['size'][0])
+    GetHeight = _from_header(sitk.Image.GetHeight, lambda header: header['size'][1])
+    GetDepth = _from_header(sitk.Image.GetDepth, lambda header: header['size'][2] if len(header['size']) > 2 else 0)
+    GetDimension = _from_header(sitk.Image.GetDimension, lambda header: len(header['size']))
+    GetSpacing = _from_header(sitk.Image.GetSpacing, lambda header: tuple(header['spacing']))
+    GetOrigin = _from_header(sitk.Image.GetOrigin, lambda header: tuple(header['origin']))
+    GetDirection = _from_header(sitk.Image.GetDirection, lambda header: tuple(header['direction']))
+    GetPixelID = _from_header(sitk.Image.GetPixelID, lambda header: header['pixel_id'])
+    GetPixelIDValue = _from_header(sitk.Image.GetPixelIDValue, lambda header: header['pixel_id'])
+    GetNumberOfComponentsPerPixel = _from_header(
+        sitk.Image.GetNumberOfComponentsPerPixel, lambda header: header['channels']
+    )
+    GetMetaDataKeys = _from_header(sitk.Image.GetMetaDataKeys, lambda header: tuple(header.get('metadata', {})))
+    HasMetaDataKey = _from_header(sitk.Image.HasMetaDataKey, lambda header, key: key in header.get('metadata', {}))
+    GetMetaData = _from_header(sitk.Image.GetMetaData, lambda header, key: header['metadata'][key])
+    SetSpacing = _to_header(sitk.Image.SetSpacing, 'spacing')
+    SetOrigin = _to_header(sitk.Image.SetOrigin, 'origin')
+    SetDirection = _to_header(sitk.Image.SetDirection, 'direction')
+
+    @property
+    def view(self) -> np.ndarray:
+        '''
+            Read-only, zero-copy voxel array (D H W [C]). It shares memory with
+            the image, so it must not be used after the image has been modified.
+            Lazy chunked volumes are served from their memory map without loading.
+        '''
+        if self._view is None:
+            if self.is_loaded or not self._header.get('chunked'):
+                self._view = sitk.GetArrayViewFromImage(self)
+            else:
+                self._view = io.imread_array(self._header)
+        return np.asarray(_ImageBuffer(self, self._view))
+
+    @property
+    def array(self) -> np.ndarray:
+        return self.view
+
+    def to_array(self) -> np.ndarray:
+        return np.array(self.view)
+
+    def buffer(self) -> np.ndarray:
+        '''
+            Writable, zero-copy voxel array (D H W [C]). The image is made unique first,
+            so copies sharing its voxels are not changed.
+        '''
+        self.MakeUnique()
+        return np.asarray(_ImageBuffer(self, sitk.GetArrayViewFromImage(self), writable=True))
+
+    def invalidate(self):
+        self._view = None
+
+    SetPixel = _modifies_buffer(sitk.Image.SetPixel)
+    MakeUnique = _modifies_buffer(sitk.Image.MakeUnique)
+    __setitem__ = _modifies_buffer(sitk.Image.__setitem__)
+    __iadd__ = _modifies_buffer(sitk.Image.__iadd__)
+    __isub__ = _modifies_buffer(sitk.Image.__isub__)
+    __imul__ = _modifies_buffer(sitk.Image.__imul__)
+    __itruediv__ = _modifies_buffer(sitk.Image.__itruediv__)
+    __ifloordiv__ = _modifies_buffer(sitk.Image.__ifloordiv__)
+    __imod__ = _modifies_buffer(sitk.Image.__imod__)
+    __ipow__ = _modifies_buffer(sitk.Image.__ipow__)
+    __iand__ = _modifies_buffer(sitk.Image.__iand__)
+    __ior__ = _modifies_buffer(sitk.Image.__ior__)
+    __ixor__ = _modifies_buffer(sitk.Image.__ixor__)
 
     @property
     def dim(self):
@@ -73,13 +210,18 @@ class Image(sitk.Image):
 
     @property
     def center(self):
-        return np.asarray(
-            self.TransformContinuousIndexToPhysicalPoint(self.size / 2.)
-        )
+        direction = self.direction.reshape(self.dim, self.dim)
+        return self.origin + direction @ (self.spacing * self.size / 2.)
 
     @property
     def shape(self):
-        return self.array.shape
+        shape = tuple(self.GetSize()[::-1])
+        channels = self.GetNumberOfComponentsPerPixel()
+        return shape + (channels,) if channels > 1 else shape
+
+    @property
+    def dtype(self):
+        return np.dtype(numpy_dtypes[self.GetPixelID()])
 
     @property
     def size(self):
@@ -88,18 +230,51 @@ class Image(sitk.Image):
     @property
     def tensor(self):
         if self.channels == 1:
-            return from_numpy(self.array[np.newaxis, ...]) # put channel first
-        elif self.channels in (3, 4):
-            return from_numpy(np.moveaxis(self.array, -1, 0))
+            return from_numpy(self.to_array()[np.newaxis, ...]) # put channel first
+        else:
+            return from_numpy(np.moveaxis(self.to_array(), -1, 0))
+
+    def crop(self, index:Sequence[int], size:Sequence[int]) -> 'Image':
+        '''
+            Sub-image of `size` voxels from `index`. An image that isn't loaded yet stays lazy,
+            only the region is read when it is.
+        '''
+        if not self.is_loaded and self._header.get('orientation', 'LPS') == 'LPS':
+            return Image(io.crop_header(self._header, index, size), type=self.type)
+        return Image(sitk.RegionOfInterest(self, [int(s) for s in size], [int(i) for i in index]), type=self.type)
+
+    def __copy__(self):
+        # shares the voxel buffer copy-on-write, a lazy image stays lazy
+        if self.is_loaded:
+            return Image(sitk.Image(self), type=self.type)
+        return Image(dict(self._header), type=self.type)
+
+    def __reduce_ex__(self, protocol):
+        if not self.is_loaded:
+            return Image, (dict(self._header), 'LPS', self.type)
+        _, args, state = super().__reduce_ex__(protocol)
+        return _rebuild_image, (args, self.type), state
 
-    def save(self, path:Union[str, List[str]]):
-        io.imsave(self, path)
+    def __deepcopy__(self, memo):
+        image = Image(sitk.Image(self), type=self.type)
+        image.MakeUnique()
+        return image
+
+    def save(self, path:Union[str, List[str]], **kwargs):
+        if io.async_writer is not None:
+            return io.async_writer.submit(self, path, **kwargs)
+        io.imsave(self, path, **kwargs)
+
+
+def _rebuild_image(args, type):
+    # SimpleITK's pickle state is restored into the image by __setstate__
+    return Image(sitk.Image(*args), type=type)
 
 
 class Subject(dict):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.images = self.get_images()
+    @property
+    def images(self):
+        return self.get_images()
 
     def get_images(self):
         images = {}
@@ -109,5 +284,12 @@ class Subject(dict):
         return images
     
     def clone(self):
-        from copy import deepcopy
-        return deepcopy(self)
\ No newline at end of file
+        '''
+            Shallow clone: images share their voxels copy-on-write with this subject, so only
+            the images that get modified or replaced in the clone are ever copied.
+        '''
+        from copy import copy, deepcopy
+        images = self.images
+        return type(self)(**{
+            name: copy(value) if name in images else deepcopy(value) for name, value in self.items()
+        })
\ No newline at end of file
@@ -0,0 +1,124 @@
+from typing import Callable, Iterator, Sequence, Tuple, Union
+import SimpleITK as sitk
+import numpy as np
+import torch
+
+from .image import Image
+
+
+def gaussian_weights(patch_size:Sequence[int], sigma_scale:float=1 / 8) -> np.ndarray:
+    '''
+        Separable gaussian centered on the patch, down-weighting patch borders when blending.
+    '''
+    weights = np.ones((), dtype=np.float32)
+    for size in patch_size:
+        x = np.arange(size, dtype=np.float32) - (size - 1) / 2
+        axis = np.exp(-0.5 * (x / max(size * sigma_scale, 1e-3)) ** 2)
+        weights = np.multiply.outer(weights, axis)
+    weights /= weights.max()
+    return np.maximum(weights, 1e-3).astype(np.float32) # keep borders from dividing by ~0
+
+
+class GridSampler:
+    '''
+        Regular grid of patches of `patch_size` (D H W) covering the whole image, neighbours
+        overlapping by `overlap` (a fraction of the patch size). Images smaller than a patch
+        are padded at the end.
+    '''
+    def __init__(self, image:Union[Image, sitk.Image], patch_size:Sequence[int], overlap:float=0.5) -> None:
+        self.image = image if isinstance(image, Image) else Image(image)
+        self.patch_size = np.asarray(patch_size)
+        self.shape = np.asarray(self.image.shape[:len(self.patch_size)])
+        view = self.image.view
+        if np.any(self.shape < self.patch_size):
+            pad = [(0, max(p - s, 0)) for p, s in zip(self.patch_size, self.shape)]
+            view = np.pad(view, pad + [(0, 0)] * (view.ndim - len(pad)))
+        self.view = view
+        steps = np.maximum((self.patch_size * (1 - overlap)).astype(int), 1)
+        self.locations = np.stack(np.meshgrid(*[
+            self._starts(n, p, step) for n, p, step in zip(view.shape, self.patch_size, steps)
+        ], indexing='ij'), axis=-1).reshape(-1, len(self.patch_size))
+
+    @staticmethod
+    def _starts(size:int, patch:int, step:int) -> np.ndarray:
+        starts = list(range(0, size - patch + 1, step))
+        if starts[-1] != size - patch:
+            starts.append(size - patch)
+        return np.asarray(starts)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def box(self, start:np.ndarray) -> Tuple[slice]:
+        return tuple(slice(s, s + p) for s, p in zip(start, self.patch_size))
+
+    def batches(self, batch_size:int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        '''
+            Yields (locations, patches) with patches as a B C D H W array.
+        '''
+        vector = self.view.ndim > len(self.patch_size)
+        for i in range(0, len(self.locations), batch_size):
+            locations = self.locations[i:i + batch_size]
+            patches = np.stack([self.view[self.box(start)] for start in locations])
+            patches = np.moveaxis(patches, -1, 1) if vector else patches[:, np.newaxis]
+            yield locations, patches
+
+
+class PatchAggregator:
+    '''
+        Blends overlapping patch predictions (C D H W) into one preallocated output, weighting
+        every patch by a gaussian ('gaussian') or uniformly ('average').
+    '''
+    def __init__(self, sampler:GridSampler, channels:int, mode:str='gaussian') -> None:
+        self.sampler = sampler
+        shape = tuple(sampler.view.shape[:len(sampler.patch_size)])
+        self.output = np.zeros((channels,) + shape, dtype=np.float32)
+        self.weight_sum = np.zeros(shape, dtype=np.float32)
+        if mode == 'gaussian':
+            self.weights = gaussian_weights(sampler.patch_size)
+        elif mode == 'average':
+            self.weights = np.ones(tuple(sampler.patch_size), dtype=np.float32)
+        else:
+            raise ValueError(f"Unknown aggregation mode: {mode}!")
+
+    def add(self, locations:np.ndarray, predictions:np.ndarray):
+        for start, prediction in zip(locations, predictions):
+            box = self.sampler.box(start)
+            self.output[(slice(None),) + box] += prediction * self.weights
+            self.weight_sum[box] += self.weights
+
+    def result(self) -> Image:
+        shape = self.sampler.shape
+        output = self.output[(slice(None),) + tuple(slice(0, s) for s in shape)]
+        output /= self.weight_sum[tuple(slice(0, s) for s in shape)]
+        if len(output) == 1:
+            image = Image(output[0])
+        else:
+            image = Image(np.moveaxis(output, 0, -1), is_vector=True)
+        image.CopyInformation(self.sampler.image)
+        return image
+
+
+def sliding_window_inference(
+    image:Union[Image, sitk.Image],
+    model:Callable[[torch.Tensor], torch.Tensor],
+    patch_size:Sequence[int],
+    overlap:float = 0.5,
+    batch_size:int = 4,
+    mode:str = 'gaussian',
+    device:Union[str, torch.device] = 'cpu'
+) -> Image:
+    '''
+        Runs `model` (B C D H W -> B C' D H W) over the whole image patch by patch and returns
+        the blended prediction with the geometry of `image`.
+    '''
+    sampler = GridSampler(image, patch_size, overlap)
+    aggregator = None
+    with torch.no_grad():
+        for locations, patches in sampler.batches(batch_size):
+            inputs = torch.from_numpy(patches.astype(np.float32, copy=False)).to(device)
+            predictions = model(inputs).float().cpu().numpy()
+            if aggregator is None:
+                aggregator = PatchAggregator(sampler, predictions.shape[1], mode)
+            aggregator.add(locations, predictions)
+    return aggregator.result()
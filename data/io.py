@@ -1,16 +1,326 @@
 import os
-from typing import Union, List
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import product
+from typing import Dict, Sequence, Tuple, Union, List
 import SimpleITK as sitk
 import numpy as np
 
+from config import DataType, numpy_dtypes
+from .cache import ImageCache, image_nbytes
+from .chunked import ChunkedVolume, is_chunked, write_chunked, extension as chunked_extension
+
 formats = ['.jpg', '.jpeg', '.bmp', '.png', '.tif', '.tiff']
 image_2d_formats = formats + [s.upper() for s in formats]
 
+SERIES_INSTANCE_UID = '0020|000e'
+
 
-def imread(image_path:Union[str, List[str]], orientation:str='LPS') -> sitk.Image:
+def _read_dicom_header(file_name:str):
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO('GDCMImageIO')
+    reader.SetFileName(file_name)
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        return None # not a DICOM file
+    return {
+        'file_name': file_name,
+        'series': reader.GetMetaData(SERIES_INSTANCE_UID).strip() if reader.HasMetaDataKey(SERIES_INSTANCE_UID) else '',
+        'size': reader.GetSize(),
+        'pixel_id': reader.GetPixelID(),
+        'spacing': reader.GetSpacing(),
+        'origin': reader.GetOrigin(),
+        'direction': reader.GetDirection(),
+    }
+
+
+def scan_dicom_series(directory:str, workers:int=None) -> Dict[str, List[dict]]:
+    '''
+        Reads every DICOM header in `directory` once and groups them by SeriesInstanceUID.
+        The headers of each series are sorted by slice position along the slice normal.
+    '''
+    file_names = sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if os.path.isfile(os.path.join(directory, name))
+    )
+    with ThreadPoolExecutor(workers) as executor:
+        headers = [header for header in executor.map(_read_dicom_header, file_names) if header is not None]
+
+    series = {}
+    for header in headers:
+        series.setdefault(header['series'], []).append(header)
+    for uid, series_headers in series.items():
+        normal = np.asarray(series_headers[0]['direction']).reshape(3, 3)[:, 2]
+        series_headers.sort(key=lambda header: float(np.dot(header['origin'], normal)))
+    return series
+
+
+def _series_header(headers:List[dict]) -> dict:
+    first = headers[0]
+    pixel_ids = {header['pixel_id'] for header in headers}
+    pixel_id = pixel_ids.pop() if len(pixel_ids) == 1 else DataType.Float32 # mixed rescaled slices
+    spacing = first['spacing']
+    if len(headers) > 1:
+        normal = np.asarray(first['direction']).reshape(3, 3)[:, 2]
+        thickness = np.dot(np.subtract(headers[-1]['origin'], first['origin']), normal) / (len(headers) - 1)
+        spacing = (spacing[0], spacing[1], abs(thickness) or spacing[2])
+    return {
+        'size': (first['size'][0], first['size'][1], len(headers)),
+        'spacing': spacing,
+        'origin': first['origin'],
+        'direction': first['direction'],
+        'pixel_id': pixel_id,
+        'channels': sitk.Image([1, 1], pixel_id).GetNumberOfComponentsPerPixel(),
+        'slices': headers,
+    }
+
+
+def read_dicom_series(headers:List[dict], workers:int=None) -> sitk.Image:
+    '''
+        Decodes the slices of one series (as returned by `scan_dicom_series`) on a thread pool
+        straight into a preallocated volume.
+    '''
+    file_names = [header['file_name'] for header in headers]
+    if len(headers) == 1 or any(header['size'][2] > 1 for header in headers):
+        return sitk.ReadImage(file_names) # single or multi-frame files
+
+    header = _series_header(headers)
+    width, height, depth = header['size']
+    pixel_id, channels = header['pixel_id'], header['channels']
+    shape = (depth, height, width) + ((channels,) if channels > 1 else ())
+    volume = np.empty(shape, dtype=numpy_dtypes[pixel_id])
+
+    def decode(index:int):
+        image = sitk.ReadImage(file_names[index], pixel_id) # must outlive its array view
+        volume[index] = sitk.GetArrayViewFromImage(image)[0]
+
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(decode, range(len(file_names))))
+
+    image = sitk.GetImageFromArray(volume, isVector=channels > 1)
+    image.SetSpacing(header['spacing'])
+    image.SetOrigin(header['origin'])
+    image.SetDirection(header['direction'])
+    return image
+
+
+def _select_series(directory:str, series:str=None, workers:int=None) -> List[dict]:
+    all_series = scan_dicom_series(directory, workers)
+    # without a SeriesInstanceUID, the series with the most slices is read
+    return all_series[series] if series is not None else max(all_series.values(), key=len)
+
+
+def orient_header(header:dict, orientation:str) -> dict:
+    '''
+        Computes the geometry `sitk.DICOMOrient` would give the image described by `header`,
+        without touching any voxel.
+    '''
+    dim = len(header['size'])
+    probe = sitk.Image([2] * dim, sitk.sitkUInt8)
+    probe.SetDirection(header['direction'])
+    oriented = np.asarray(sitk.DICOMOrient(probe, orientation).GetDirection()).reshape(dim, dim)
+    direction = np.asarray(header['direction']).reshape(dim, dim)
+    permutation = np.rint(direction.T @ oriented).astype(int) # oriented = direction @ permutation
+    axes = np.abs(permutation).argmax(axis=0)
+    flipped = permutation[axes, np.arange(dim)] < 0
+
+    size, spacing = np.asarray(header['size']), np.asarray(header['spacing'])
+    corner = np.zeros(dim)
+    corner[axes] = np.where(flipped, size[axes] - 1, 0)
+    return dict(
+        header,
+        size=tuple(int(s) for s in size[axes]),
+        spacing=tuple(float(s) for s in spacing[axes]),
+        origin=tuple(float(o) for o in np.asarray(header['origin']) + direction @ (spacing * corner)),
+        direction=tuple(float(d) for d in oriented.ravel()),
+    )
+
+
+def _index_to_physical(header:dict, index:np.ndarray) -> np.ndarray:
+    dim = len(header['size'])
+    direction = np.asarray(header['direction']).reshape(dim, dim)
+    return np.asarray(header['origin']) + (np.asarray(index) * header['spacing']) @ direction.T
+
+
+def _physical_to_index(header:dict, points:np.ndarray) -> np.ndarray:
+    dim = len(header['size'])
+    direction = np.asarray(header['direction']).reshape(dim, dim)
+    return np.linalg.solve(direction, (np.asarray(points) - header['origin']).T).T / header['spacing']
+
+
+def _file_region(header:dict, region:Tuple[Sequence[float], Sequence[float]], physical:bool, orientation:str):
+    '''
+        Converts `region` into (index, size) in the index space of the file described by `header`.
+        `region` is (index, size) of the image as returned by `imread`, or two opposite physical
+        corners when `physical` is True.
+    '''
+    if physical:
+        corners = np.asarray(list(product(*zip(*region))), dtype=float)
+        indexes = _physical_to_index(header, corners)
+    else:
+        index, size = np.asarray(region[0]), np.asarray(region[1])
+        indexes = np.stack([index, index + size - 1])
+        if orientation != 'LPS':
+            indexes = _physical_to_index(header, _index_to_physical(orient_header(header, orientation), indexes))
+    lower = np.maximum(np.ceil(indexes.min(axis=0) - 1e-3), 0).astype(int)
+    upper = np.minimum(np.floor(indexes.max(axis=0) + 1e-3), np.asarray(header['size']) - 1).astype(int)
+    if np.any(upper < lower):
+        raise ValueError("Region does not overlap the image!")
+    return tuple(int(i) for i in lower), tuple(int(s) for s in upper - lower + 1)
+
+
+def crop_header(header:dict, index:Sequence[int], size:Sequence[int]) -> dict:
+    header = dict(header, size=tuple(int(s) for s in size),
+                  origin=tuple(float(o) for o in _index_to_physical(header, index)))
+    if 'slices' in header:
+        header['slices'] = header['slices'][index[2]:index[2] + size[2]]
+        index = (index[0], index[1], 0)
+    if 'region' in header:
+        index = tuple(np.add(header['region'][0], index))
+    header['region'] = (tuple(index), tuple(size))
+    return header
+
+
+def _chunked_header(path:str) -> dict:
+    info = ChunkedVolume(path).header
+    dim = len(info['spacing'])
+    return {
+        'size': tuple(info['shape'][:dim][::-1]),
+        'spacing': tuple(info['spacing']),
+        'origin': tuple(info['origin']),
+        'direction': tuple(info['direction']),
+        'pixel_id': info['pixel_id'],
+        'channels': info['channels'],
+        'metadata': info.get('metadata', {}),
+        'chunked': True,
+    }
+
+
+def _read_chunked(header:dict, workers:int=None) -> np.ndarray:
+    volume = ChunkedVolume(header['path'], workers)
+    dim = len(volume.header['spacing'])
+    index, size = header.get('region', ((0,) * dim, volume.shape[:dim][::-1]))
+    return volume.read(tuple(index)[::-1], tuple(np.add(index, size))[::-1])
+
+
+def imread_array(header:dict, workers:int=None) -> np.ndarray:
+    '''
+        Voxels (D H W [C]) of the image described by `header`. Uncompressed chunked volumes
+        are returned as a read-only memory map, without copying.
+    '''
+    if header.get('chunked') and header['orientation'] == 'LPS':
+        array = _read_chunked(header, workers)
+        array.flags.writeable = False
+        return array
+    return sitk.GetArrayFromImage(imread_from_header(header, workers))
+
+
+def imread_header(image_path:str, orientation:str='LPS', series:str=None, workers:int=None,
+                  region:Tuple[Sequence[float], Sequence[float]]=None, physical:bool=False) -> dict:
+    '''
+        Reads size, spacing, origin, direction and pixel type of an image without loading its voxels.
+        With `region`, the header describes only that sub-volume (see `_file_region`).
+    '''
+    if is_chunked(image_path):
+        header = _chunked_header(image_path)
+    elif os.path.isdir(image_path):
+        header = _series_header(_select_series(image_path, series, workers))
+    else:
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(image_path)
+        reader.ReadImageInformation()
+        header = {
+            'size': reader.GetSize(),
+            'spacing': reader.GetSpacing(),
+            'origin': reader.GetOrigin(),
+            'direction': reader.GetDirection(),
+            'pixel_id': reader.GetPixelID(),
+            'channels': reader.GetNumberOfComponents(),
+            'metadata': {key: reader.GetMetaData(key) for key in reader.GetMetaDataKeys()},
+        }
+    header.update(path=image_path, orientation=orientation)
+    if region is not None:
+        header = crop_header(header, *_file_region(header, region, physical, orientation))
+    return header if orientation == 'LPS' else orient_header(header, orientation)
+
+
+def imread_from_header(header:dict, workers:int=None) -> sitk.Image:
+    if header.get('chunked'):
+        file_header = _chunked_header(header['path'])
+        image = sitk.GetImageFromArray(_read_chunked(header, workers), isVector=file_header['channels'] > 1)
+        image.SetSpacing(file_header['spacing'])
+        image.SetOrigin(_index_to_physical(file_header, header.get('region', ((0,) * image.GetDimension(),))[0]))
+        image.SetDirection(file_header['direction'])
+    elif 'slices' in header:
+        image = read_dicom_series(header['slices'], workers)
+        if 'region' in header:
+            # slices are already selected, only the in-plane region is left
+            index, size = header['region']
+            image = sitk.RegionOfInterest(image, size, index)
+    else:
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(header['path'])
+        if 'region' in header:
+            # streamed by the image IOs that support it
+            reader.SetExtractIndex(header['region'][0])
+            reader.SetExtractSize(header['region'][1])
+        image = reader.Execute()
+    if header['orientation'] == 'LPS':
+        return image
+    else:
+        return sitk.DICOMOrient(image, header['orientation'])
+
+
+def imread_series(directory:str, orientation:str='LPS', workers:int=None) -> Dict[str, sitk.Image]:
+    images = {}
+    for uid, headers in scan_dicom_series(directory, workers).items():
+        image = read_dicom_series(headers, workers)
+        images[uid] = image if orientation == 'LPS' else sitk.DICOMOrient(image, orientation)
+    return images
+
+
+image_cache: ImageCache = None
+
+
+def enable_cache(max_bytes:int=2**32) -> ImageCache:
+    '''
+        Caches images read by `imread` (and `Image(path)`) by path, modification time, file size
+        and read options, evicting the least recently used ones beyond `max_bytes`.
+    '''
+    global image_cache
+    image_cache = ImageCache(max_bytes)
+    return image_cache
+
+
+def disable_cache():
+    global image_cache
+    image_cache = None
+
+
+def imread(image_path:Union[str, List[str]], orientation:str='LPS', 
+           series:str=None, workers:int=None, lazy:bool=False,
+           region:Tuple[Sequence[float], Sequence[float]]=None, physical:bool=False) -> sitk.Image:
+    if image_cache is not None and isinstance(image_path, str) and not lazy and os.path.exists(image_path):
+        key = image_cache.key(image_path, orientation, series, region, physical)
+        return image_cache.get(key, lambda: _imread(image_path, orientation, series, workers, lazy, region, physical))
+    return _imread(image_path, orientation, series, workers, lazy, region, physical)
+
+
+def _imread(image_path:Union[str, List[str]], orientation:str='LPS', 
+            series:str=None, workers:int=None, lazy:bool=False,
+            region:Tuple[Sequence[float], Sequence[float]]=None, physical:bool=False) -> sitk.Image:
+    if region is not None and not isinstance(image_path, str):
+        raise ValueError("A region can only be read from a single file or a DICOM directory, not a list of files!")
+    if isinstance(image_path, str) and (lazy or region is not None or is_chunked(image_path)):
+        header = imread_header(image_path, orientation, series, workers, region, physical)
+        if lazy:
+            from .image import Image
+            return Image(header)
+        return imread_from_header(header, workers)
     try:
         if isinstance(image_path, str) and os.path.isdir(image_path):
-            image = sitk.ReadImage(sitk.ImageSeriesReader_GetGDCMSeriesFileNames(image_path))
+            image = read_dicom_series(_select_series(image_path, series, workers), workers)
         else:
             image = sitk.ReadImage(image_path)
         if orientation == 'LPS':
@@ -20,10 +330,111 @@ def imread(image_path:Union[str, List[str]], orientation:str='LPS') -> sitk.Imag
     except Exception as e:
         print(e)
 
-def imsave(image:sitk.Image, image_path:Union[str, List[str]]):
+def imsave(image:sitk.Image, image_path:Union[str, List[str]],
+           compression:Union[bool, str]=None, level:int=None, chunks:Sequence[int]=(64, 64, 64)):
+    '''
+        `compression` turns compression on or off for formats that support it (chunked volumes
+        also accept 'zlib' or 'lz4'), `level` is the compression level (None for the default).
+    '''
     example = image_path if isinstance(image_path, str) else image_path[0]
-    if example.endswith(image_2d_formats):
+    if example.endswith(chunked_extension):
+        info = {
+            'spacing': image.GetSpacing(),
+            'origin': image.GetOrigin(),
+            'direction': image.GetDirection(),
+            'pixel_id': image.GetPixelID(),
+            'channels': image.GetNumberOfComponentsPerPixel(),
+            'metadata': {key: image.GetMetaData(key) for key in image.GetMetaDataKeys()},
+        }
+        compression = 'zlib' if compression is True else compression or None
+        return write_chunked(image_path, sitk.GetArrayViewFromImage(image), info, chunks, compression,
+                             1 if level is None else level)
+    if example.endswith(tuple(image_2d_formats)):
         image = sitk.Cast(
             sitk.RescaleIntensity(image), sitk.sitkUInt8
         )
-    sitk.WriteImage(image, image_path)
\ No newline at end of file
+    if compression is None:
+        sitk.WriteImage(image, image_path)
+    else:
+        sitk.WriteImage(image, image_path, bool(compression), -1 if level is None else level)
+
+
+class AsyncWriter:
+    '''
+        Saves images on background threads. `submit` blocks while the images waiting to be
+        written exceed `max_bytes`, so a fast producer can't fill up the memory.
+    '''
+    def __init__(self, workers:int=1, max_bytes:int=2**30) -> None:
+        self.executor = ThreadPoolExecutor(workers)
+        self.max_bytes = max_bytes
+        self.pending_bytes = 0
+        self.futures = set()
+        self.errors = []
+        self.condition = threading.Condition()
+
+    def submit(self, image:sitk.Image, image_path:Union[str, List[str]], **kwargs) -> Future:
+        image = sitk.Image(image) # copy-on-write, later changes of the caller's image aren't saved
+        nbytes = image_nbytes(image)
+        with self.condition:
+            # an image larger than the budget is still accepted when nothing else is pending
+            self.condition.wait_for(lambda: not self.futures or self.pending_bytes + nbytes <= self.max_bytes)
+            self.pending_bytes += nbytes
+            future = self.executor.submit(imsave, image, image_path, **kwargs)
+            self.futures.add(future)
+        future.add_done_callback(lambda future: self._release(future, nbytes))
+        return future
+
+    def _release(self, future:Future, nbytes:int):
+        with self.condition:
+            self.pending_bytes -= nbytes
+            self.futures.discard(future)
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+            self.condition.notify_all()
+
+    def flush(self):
+        '''
+            Waits until every submitted image is written and raises the first error, if any.
+        '''
+        with self.condition:
+            self.condition.wait_for(lambda: not self.futures)
+            errors, self.errors = self.errors, []
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+async_writer: AsyncWriter = None
+
+
+def enable_async_save(workers:int=1, max_bytes:int=2**30) -> AsyncWriter:
+    '''
+        Makes `Image.save` return immediately and write through a shared `AsyncWriter`.
+    '''
+    global async_writer
+    disable_async_save()
+    async_writer = AsyncWriter(workers, max_bytes)
+    return async_writer
+
+
+def disable_async_save():
+    global async_writer
+    writer, async_writer = async_writer, None
+    if writer is not None:
+        writer.close()
+
+
+def flush():
+    if async_writer is not None:
+        async_writer.flush()
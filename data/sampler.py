@@ -0,0 +1,153 @@
+from typing import Dict, Iterator, List, Sequence
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+
+from .image import Image, Subject
+from .dataset import SubjectDataset, array_to_tensor
+
+
+class PatchSampler:
+    '''
+        Draws patches of `patch_size` (D H W) from a subject. Patches are numpy views of the
+        subject's images, nothing is copied until they are turned into tensors.
+    '''
+    def __init__(self, patch_size:Sequence[int]) -> None:
+        self.patch_size = np.asarray(patch_size)
+
+    def __call__(self, subject:Subject, num_patches:int, rng:np.random.Generator=None) -> List[dict]:
+        rng = np.random.default_rng() if rng is None else rng
+        images = {
+            name: image if isinstance(image, Image) else Image(image) for name, image in subject.images.items()
+        }
+        shape = np.asarray(next(iter(images.values())).shape[:len(self.patch_size)])
+        if np.any(shape < self.patch_size):
+            raise ValueError(f"Patch size {tuple(self.patch_size)} is larger than the image {tuple(shape)}!")
+        views = {name: image.view for name, image in images.items()}
+
+        patches = []
+        for start in self.locations(views, shape, num_patches, rng):
+            box = tuple(slice(s, s + p) for s, p in zip(start, self.patch_size))
+            patch = {name: value for name, value in subject.items() if name not in images}
+            patch.update({name: view[box] for name, view in views.items()})
+            patch['location'] = start
+            patches.append(patch)
+        return patches
+
+    def locations(self, views:Dict[str, np.ndarray], shape:np.ndarray, num_patches:int,
+                  rng:np.random.Generator) -> np.ndarray:
+        raise NotImplementedError
+
+    def _starts(self, centers:np.ndarray, shape:np.ndarray) -> np.ndarray:
+        return np.clip(centers - self.patch_size // 2, 0, shape - self.patch_size)
+
+    def _uniform(self, shape:np.ndarray, num_patches:int, rng:np.random.Generator) -> np.ndarray:
+        return rng.integers(0, shape - self.patch_size + 1, size=(num_patches, len(shape)))
+
+
+class UniformSampler(PatchSampler):
+    def locations(self, views, shape, num_patches, rng):
+        return self._uniform(shape, num_patches, rng)
+
+
+class LabelSampler(PatchSampler):
+    '''
+        Centers patches on voxels of the labels in `probabilities` (label value -> probability) of
+        the label map `label_key`. Voxels of every label are found once per subject.
+    '''
+    def __init__(self, patch_size:Sequence[int], label_key:str, probabilities:Dict[int, float]) -> None:
+        super().__init__(patch_size)
+        self.label_key = label_key
+        self.probabilities = probabilities
+
+    def locations(self, views, shape, num_patches, rng):
+        label = views[self.label_key].ravel()
+        voxels = {value: np.flatnonzero(label == value) for value in self.probabilities}
+        values = [value for value in self.probabilities if len(voxels[value])]
+        if not values:
+            return self._uniform(shape, num_patches, rng)
+        weights = np.asarray([self.probabilities[value] for value in values], dtype=float)
+        chosen = rng.choice(len(values), size=num_patches, p=weights / weights.sum())
+        centers = np.stack([
+            np.unravel_index(rng.choice(voxels[values[i]]), tuple(shape)) for i in chosen
+        ])
+        return self._starts(centers, shape)
+
+
+class ForegroundSampler(PatchSampler):
+    '''
+        Centers a patch on a foreground voxel (`key` image above `threshold`) with probability
+        `foreground_probability`, anywhere otherwise.
+    '''
+    def __init__(self, patch_size:Sequence[int], key:str, foreground_probability:float=0.5,
+                 threshold:float=0) -> None:
+        super().__init__(patch_size)
+        self.key = key
+        self.foreground_probability = foreground_probability
+        self.threshold = threshold
+
+    def locations(self, views, shape, num_patches, rng):
+        starts = self._uniform(shape, num_patches, rng)
+        foreground = np.flatnonzero(views[self.key].ravel() > self.threshold)
+        biased = rng.random(num_patches) < self.foreground_probability
+        if len(foreground) and biased.any():
+            centers = np.stack(np.unravel_index(rng.choice(foreground, size=biased.sum()), tuple(shape)), axis=-1)
+            starts[biased] = self._starts(centers, shape)
+        return starts
+
+
+class PatchQueue(IterableDataset):
+    '''
+        Loads every subject of `dataset` once, draws `patches_per_subject` patches from it and
+        yields them as tensors in random order from a buffer of at most `max_length` patches,
+        so consecutive patches come from different subjects. Under a DataLoader the subjects
+        are split among the workers, each with its own random stream.
+    '''
+    def __init__(
+        self,
+        dataset:SubjectDataset,
+        sampler:PatchSampler,
+        patches_per_subject:int,
+        max_length:int,
+        shuffle_subjects:bool = True,
+        seed:int = None
+    ) -> None:
+        self.dataset = dataset
+        self.sampler = sampler
+        self.patches_per_subject = patches_per_subject
+        self.max_length = max_length
+        self.shuffle_subjects = shuffle_subjects
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.dataset) * self.patches_per_subject
+
+    def __iter__(self) -> Iterator[dict]:
+        worker = get_worker_info()
+        if worker is None:
+            worker_id, num_workers = 0, 1
+            seed = np.random.SeedSequence(self.seed).entropy
+        else:
+            # the workers of one epoch share torch's base seed, so they agree on the subject order
+            worker_id, num_workers = worker.id, worker.num_workers
+            seed = self.seed if self.seed is not None else worker.seed - worker.id
+        indexes = np.arange(len(self.dataset))
+        if self.shuffle_subjects:
+            indexes = np.random.default_rng(seed).permutation(indexes)
+        rng = np.random.default_rng(np.random.SeedSequence(seed).spawn(num_workers)[worker_id])
+
+        buffer = []
+        for index in indexes[worker_id::num_workers]:
+            subject = self.dataset.subject(index)
+            buffer.extend(self.sampler(subject, self.patches_per_subject, rng))
+            while len(buffer) >= self.max_length:
+                yield self._to_tensors(buffer.pop(rng.integers(len(buffer))))
+        while buffer:
+            yield self._to_tensors(buffer.pop(rng.integers(len(buffer))))
+
+    def _to_tensors(self, patch:dict) -> dict:
+        ndim = len(self.sampler.patch_size)
+        return {
+            name: array_to_tensor(value, value.ndim > ndim, shared=False)
+            if isinstance(value, np.ndarray) and name != 'location' else value
+            for name, value in patch.items()
+        }
@@ -1,4 +1,6 @@
 from .utils import Composite
+from .cache import TransformCache
+from .profile import Profiler
 from .intensity import (
     Rescale, rescale,
     Clip, clip,
@@ -7,5 +9,15 @@ from .intensity import (
 from .spatial import (
     Pad, pad,
     Crop, crop,
+    CropToForeground,
     Flip, flip
-)
\ No newline at end of file
+)
+from .random import (
+    RandomAffine,
+    RandomElastic,
+    RandomFlip,
+    RandomSpatial,
+    RandomGamma,
+    RandomNoise,
+    RandomBiasField
+)
@@ -0,0 +1,182 @@
+import os
+import json
+import pickle
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Sequence, Union
+
+from data.image import Image, Subject
+from data.io import imsave
+from config import ImageType
+from .utils import dumps
+
+
+def item_id(index:int, item:Union[str, dict, Subject]) -> str:
+    if isinstance(item, str):
+        return item
+    if isinstance(item, dict) and 'id' in item:
+        return str(item['id'])
+    return str(index)
+
+
+def load_item(item:Union[str, dict, Subject], label_keys:Sequence[str]=()):
+    '''
+        A path is read as an image; in a dict every string value but 'id' is read as an image.
+    '''
+    if isinstance(item, str):
+        return Image(item)
+    if isinstance(item, Subject):
+        return item
+    return Subject(**{
+        name: Image(value, type=ImageType.Label if name in label_keys else ImageType.Scalar)
+        if isinstance(value, str) and name != 'id' else value for name, value in item.items()
+    })
+
+
+def output_names(inputs:Sequence[Union[str, dict, Subject]]) -> List[str]:
+    '''
+        Where every input is written under the output directory: paths relative to the common
+        directory of the input paths (so `p1/ct.nii.gz` and `p2/ct.nii.gz` stay apart), ids
+        of dicts, indexes otherwise. Raises ValueError when two inputs would share outputs.
+    '''
+    paths = [os.path.abspath(item) for item in inputs if isinstance(item, str)]
+    root = os.path.commonpath([os.path.dirname(path) for path in paths]) if paths else None
+    names, seen = [], {}
+    for index, item in enumerate(inputs):
+        name = os.path.relpath(os.path.abspath(item), root) if isinstance(item, str) else item_id(index, item)
+        key = os.path.normcase(os.path.normpath(name))
+        if key in seen:
+            raise ValueError(f"Inputs {item_id(seen[key], inputs[seen[key]])} and {item_id(index, item)} "
+                             f"would be written to the same output {name}!")
+        seen[key] = index
+        names.append(name)
+    return names
+
+
+def output_paths(output:str, name:str, result:Union[Image, Subject], extension:str) -> Dict[str, str]:
+    if isinstance(result, Subject):
+        return {image: os.path.join(output, name, image + extension) for image in result.images}
+    name = os.path.normpath(name)
+    return {'image': os.path.join(output, name if os.path.splitext(name)[1] else name + extension)}
+
+
+_composite = None
+
+
+def _init_worker(pipeline:bytes):
+    global _composite
+    _composite = pickle.loads(pipeline)
+
+
+def _run_item(index:int, item:Union[str, dict, Subject], output:Union[str, Callable], label_keys:Sequence[str],
+              extension:str, composite=None, name:str=None) -> dict:
+    composite = _composite if composite is None else composite
+    id = item_id(index, item)
+    start = time.perf_counter()
+    try:
+        result = composite(load_item(item, label_keys))
+        if hasattr(result, 'compute'):
+            result = result.compute() # a lazy composite
+        if output is None:
+            record = {'result': result}
+        elif callable(output):
+            record = {'outputs': output(id, result)}
+        else:
+            paths = output_paths(output, id if name is None else name, result, extension)
+            images = result.images if isinstance(result, Subject) else {'image': result}
+            for name, path in paths.items():
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                imsave(images[name], path)
+            record = {'outputs': paths}
+        record.update(status='done')
+    except Exception:
+        record = {'status': 'failed', 'error': traceback.format_exc()}
+    record.update(id=id, index=index, seconds=time.perf_counter() - start)
+    return record
+
+
+def read_manifest(manifest:str) -> Dict[str, dict]:
+    records = {}
+    if manifest is not None and os.path.exists(manifest):
+        with open(manifest) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # a line cut by a crash
+                records[record['id']] = record
+    return records
+
+
+def run_batch(
+    composite,
+    inputs:Sequence[Union[str, dict, Subject]],
+    output:Union[str, Callable[[str, Any], Any]] = None,
+    processes:int = None,
+    manifest:str = None,
+    label_keys:Sequence[str] = (),
+    extension:str = '.nii.gz',
+    progress:Callable[[dict, int, int], None] = None
+) -> List[dict]:
+    '''
+        Runs `composite` over `inputs` (image paths, dicts of paths or Subjects) on a pool of
+        `processes` worker processes (0 runs in this process). Inputs are read and outputs
+        written inside the workers: into the `output` directory, by `output(id, result)`, or
+        returned in the records when `output` is None. Outputs are laid out as `output_names`
+        gives, which refuses inputs that would overwrite each other before anything runs.
+
+        Every item gets a record (id, status, outputs or error, seconds); a failing item
+        doesn't stop the others. Records are appended to `manifest` as they complete, and
+        items already done in it are skipped, so a crashed run resumes where it stopped.
+        `progress(record, completed, total)` is called after every item.
+    '''
+    names = output_names(inputs) if isinstance(output, str) else [None] * len(inputs)
+    done = {
+        id: record for id, record in read_manifest(manifest).items() if record['status'] == 'done'
+    }
+    records = [None] * len(inputs)
+    todo = []
+    for index, item in enumerate(inputs):
+        id = item_id(index, item)
+        if id in done:
+            records[index] = dict(done[id], status='skipped')
+        else:
+            todo.append((index, item))
+
+    log = open(manifest, 'a') if manifest is not None else None
+    completed, total = len(inputs) - len(todo), len(inputs)
+
+    def finish(record):
+        nonlocal completed
+        completed += 1
+        records[record['index']] = record
+        if log is not None:
+            log.write(json.dumps({key: value for key, value in record.items() if key != 'result'}, default=str) + '\n')
+            log.flush()
+        if progress is not None:
+            progress(record, completed, total)
+
+    try:
+        if processes == 0:
+            for index, item in todo:
+                finish(_run_item(index, item, output, label_keys, extension, composite, names[index]))
+        else:
+            with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(dumps(composite),)) as executor:
+                futures = {
+                    executor.submit(_run_item, index, item, output, label_keys, extension, None, names[index]): (index, item)
+                    for index, item in todo
+                }
+                for future in as_completed(futures):
+                    index, item = futures[future]
+                    try:
+                        record = future.result()
+                    except Exception:
+                        # the worker died (e.g. out of memory), the pool fails its pending items too
+                        record = {'id': item_id(index, item), 'index': index, 'status': 'failed',
+                                  'error': traceback.format_exc()}
+                    finish(record)
+    finally:
+        if log is not None:
+            log.close()
+    return records
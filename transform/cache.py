@@ -0,0 +1,302 @@
+import os
+import json
+import pickle
+import shutil
+import inspect
+import functools
+import hashlib
+import tempfile
+import types
+from enum import Enum
+from typing import Any, List, Optional, Sequence, Tuple, Union
+import SimpleITK as sitk
+import numpy as np
+
+from data.image import Image, Subject
+from config import ImageType
+from .utils import Composite, Transform
+
+
+_IGNORED = ('Debug', 'NumberOfThreads', 'NumberOfWorkUnits', 'Commands', 'ProgressMeasurement', 'ActiveProcess')
+
+
+def image_digest(image:Union[Image, sitk.Image]) -> str:
+    '''
+        Hash of the voxels, pixel type and geometry of an image.
+    '''
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(json.dumps([
+        image.GetPixelIDValue(), image.GetNumberOfComponentsPerPixel(), image.GetSize(),
+        image.GetSpacing(), image.GetOrigin(), image.GetDirection(),
+        getattr(image, 'type', ImageType.Scalar).value
+    ]).encode())
+    if isinstance(image, Image):
+        digest.update(np.ascontiguousarray(image.view).data)
+    else:
+        digest.update(np.ascontiguousarray(sitk.GetArrayViewFromImage(image)).data)
+    return digest.hexdigest()
+
+
+def input_digest(image:Union[Image, sitk.Image, Subject]) -> str:
+    if isinstance(image, Subject):
+        images = image.images
+        return hashlib.blake2b(json.dumps(
+            [[name, image_digest(images[name])] for name in sorted(images)]
+        ).encode(), digest_size=20).hexdigest()
+    return image_digest(image)
+
+
+def _arguments(plugin:Transform) -> dict:
+    args, kwargs = plugin._arguments
+    try:
+        bound = inspect.signature(type(plugin).__init__).bind(None, *args, **kwargs)
+        bound.apply_defaults()
+        return dict(list(bound.arguments.items())[1:])
+    except TypeError:
+        return {'args': args, 'kwargs': kwargs}
+
+
+class _Opaque(Exception):
+    pass
+
+
+def describe(plugin:Any) -> Any:
+    '''
+        Canonical, JSON-able description of a transform's parameters. Transforms are described
+        by their constructor arguments, not by their (mutable) filters and attributes; plugins
+        can define `cache_key()` to describe themselves. None for a plugin holding a callable
+        that can't be described canonically.
+    '''
+    try:
+        return _describe(plugin)
+    except _Opaque:
+        return None
+
+
+def _describe_function(function:types.FunctionType) -> list:
+    try:
+        closure = [cell.cell_contents for cell in function.__closure__ or ()]
+    except ValueError: # empty cell
+        raise _Opaque()
+    return [
+        function.__module__ + '.' + function.__qualname__, _describe(function.__code__),
+        _describe(function.__defaults__), _describe(function.__kwdefaults__), _describe(closure)
+    ]
+
+
+def _describe(plugin:Any) -> Any:
+    if hasattr(plugin, 'cache_key'):
+        return plugin.cache_key()
+    if isinstance(plugin, Transform) and hasattr(plugin, '_arguments'):
+        description = [type(plugin).__module__ + '.' + type(plugin).__qualname__, _describe(_arguments(plugin))]
+        if type(plugin).__init__ is Transform.__init__:
+            # a bare Transform is only defined by the filters appended to it
+            description.append(_describe(plugin.total_filter.composite))
+        return description
+    if isinstance(plugin, Composite):
+        return ['Composite', _describe(plugin.composite)]
+    if plugin is None or isinstance(plugin, (bool, int, float, str)):
+        return plugin
+    if isinstance(plugin, Enum):
+        return str(plugin)
+    if isinstance(plugin, np.generic):
+        return plugin.item()
+    if isinstance(plugin, np.ndarray):
+        return [str(plugin.dtype), plugin.tolist()]
+    if isinstance(plugin, (list, tuple)):
+        return [_describe(value) for value in plugin]
+    if isinstance(plugin, (set, frozenset)):
+        return sorted(json.dumps(_describe(value), sort_keys=True) for value in plugin)
+    if isinstance(plugin, dict):
+        return {str(name): _describe(value) for name, value in sorted(plugin.items(), key=lambda item: str(item[0]))}
+    if isinstance(plugin, sitk.Image):
+        return image_digest(plugin)
+    if isinstance(plugin, sitk.CompositeTransform):
+        return ['CompositeTransform'] + [
+            _describe(plugin.GetNthTransform(i)) for i in range(plugin.GetNumberOfTransforms())
+        ]
+    if isinstance(plugin, sitk.Transform):
+        return [plugin.GetName(), plugin.GetDimension(), plugin.GetParameters(), plugin.GetFixedParameters()]
+    if isinstance(plugin, sitk.ImageFilter):
+        lines = [
+            line.strip() for line in str(plugin).splitlines()
+            if line.strip() and line.split(':')[0].strip() not in _IGNORED
+        ]
+        if hasattr(plugin, 'GetTransform'):
+            lines.append(_describe(plugin.GetTransform()))
+        return lines
+    if isinstance(plugin, types.CodeType):
+        # constants tell apart functions of the same bytecode, e.g. `lambda x: x + 1` and `x + 2`
+        return [
+            hashlib.blake2b(plugin.co_code, digest_size=20).hexdigest(),
+            _describe(plugin.co_consts), list(plugin.co_names)
+        ]
+    if isinstance(plugin, types.FunctionType):
+        return _describe_function(plugin)
+    if isinstance(plugin, functools.partial):
+        return ['functools.partial', _describe(plugin.func), _describe(plugin.args), _describe(plugin.keywords)]
+    if isinstance(plugin, types.MethodType):
+        return ['method', _describe(plugin.__self__), _describe(plugin.__func__)]
+    if isinstance(plugin, (type, types.BuiltinFunctionType, np.ufunc)):
+        # defined by their name alone
+        return (getattr(plugin, '__module__', None) or '') + '.' + getattr(plugin, '__qualname__', plugin.__name__)
+    if hasattr(plugin, '__dict__'):
+        return [type(plugin).__module__ + '.' + type(plugin).__qualname__, {
+            name: _describe(value) for name, value in sorted(vars(plugin).items()) if not name.startswith('_')
+        }]
+    if callable(plugin):
+        raise _Opaque()
+    return repr(plugin)
+
+
+class TransformCache:
+    '''
+        Content-addressed disk cache of transform pipeline outputs under `directory`. The key
+        of a step's output chains the hash of the input with the description of every step up
+        to it, so a pipeline resumes from its longest cached prefix. The output of the last
+        cacheable step is stored, and those of the steps of index in `steps` (e.g. the one
+        before a step being tuned). Least recently used entries are evicted beyond `max_bytes`.
+    '''
+    def __init__(self, directory:str, max_bytes:int=2**34, steps:Sequence[int]=()) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.steps = steps
+        self.hits = 0
+        self.misses = 0
+        self._nbytes = None # bytes stored, known after the first scan
+        os.makedirs(directory, exist_ok=True)
+
+    def keys(self, image:Union[Image, sitk.Image, Subject], plugins:Sequence[Any]) -> List[Optional[str]]:
+        '''
+            Keys of the input and of every step's output; None from the first step that isn't
+            deterministic (`deterministic = False`) or can't be described (see `describe`) on.
+        '''
+        keys = [input_digest(image)]
+        for plugin in plugins:
+            description = None if keys[-1] is None or not getattr(plugin, 'deterministic', True) else describe(plugin)
+            if description is None:
+                keys.append(None)
+                continue
+            description = json.dumps([keys[-1], description], sort_keys=True, default=str)
+            keys.append(hashlib.blake2b(description.encode(), digest_size=20).hexdigest())
+        return keys
+
+    def stored(self, keys:Sequence[Optional[str]]) -> List[int]:
+        '''
+            Steps (1-based, as in `keys`) whose output is stored.
+        '''
+        count = len(keys) - 1
+        steps = {step % count + 1 for step in self.steps if -count <= step < count}
+        cacheable = [step for step in range(1, len(keys)) if keys[step] is not None]
+        if cacheable:
+            steps.add(cacheable[-1])
+        return sorted(step for step in steps if keys[step] is not None)
+
+    def path(self, key:str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def lookup(self, keys:Sequence[Optional[str]], image:Union[Image, sitk.Image, Subject]) -> Tuple[int, Any]:
+        '''
+            Returns (step, output) for the last step whose output is cached, (0, None) if none is.
+        '''
+        for step in range(len(keys) - 1, 0, -1):
+            if keys[step] is not None and os.path.isdir(self.path(keys[step])):
+                output = self.load(keys[step], image)
+                if output is not None:
+                    self.hits += 1
+                    return step, output
+        self.misses += 1
+        return 0, None
+
+    def load(self, key:str, image:Union[Image, sitk.Image, Subject]):
+        path = self.path(key)
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            images = {
+                name: Image(sitk.ReadImage(os.path.join(path, name + '.mha')), type=ImageType(value))
+                for name, value in meta['types'].items()
+            }
+            os.utime(path)
+        except (OSError, RuntimeError, ValueError):
+            return None
+        if not isinstance(image, Subject):
+            return images['image']
+        output = image.clone()
+        output.update(images)
+        entries = os.path.join(path, 'entries.pkl')
+        if os.path.exists(entries):
+            # non-image entries of the output, e.g. a crop record
+            with open(entries, 'rb') as f:
+                output.update(pickle.load(f))
+        return output
+
+    def store(self, key:str, output:Union[Image, sitk.Image, Subject]):
+        path = self.path(key)
+        if os.path.isdir(path):
+            return
+        images = output.images if isinstance(output, Subject) else {'image': output}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = tempfile.mkdtemp(prefix='.', dir=os.path.dirname(path))
+        try:
+            for name, image in images.items():
+                sitk.WriteImage(image, os.path.join(temp, name + '.mha'), useCompression=True)
+            if isinstance(output, Subject):
+                with open(os.path.join(temp, 'entries.pkl'), 'wb') as f:
+                    pickle.dump({name: value for name, value in output.items() if name not in images}, f)
+            with open(os.path.join(temp, 'meta.json'), 'w') as f:
+                json.dump({'types': {
+                    name: getattr(image, 'type', ImageType.Scalar).value for name, image in images.items()
+                }}, f)
+            nbytes = sum(entry.stat().st_size for entry in os.scandir(temp))
+            os.rename(temp, path)
+        except (OSError, pickle.PicklingError, TypeError, AttributeError):
+            # another process stored the same entry first, or an entry can't be pickled
+            shutil.rmtree(temp, ignore_errors=True)
+            return
+        # the directory is only scanned again once the limit is crossed
+        if self._nbytes is None:
+            self._nbytes = sum(entry[1] for entry in self.entries())
+        else:
+            self._nbytes += nbytes
+        if self._nbytes > self.max_bytes:
+            self.evict()
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        for prefix in os.listdir(self.directory):
+            for key in os.listdir(os.path.join(self.directory, prefix)):
+                if key.startswith('.'):
+                    continue
+                path = os.path.join(self.directory, prefix, key)
+                try:
+                    nbytes = sum(entry.stat().st_size for entry in os.scandir(path))
+                    entries.append((os.stat(path).st_mtime, nbytes, path))
+                except OSError:
+                    continue
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        nbytes = sum(entry[1] for entry in entries)
+        for _, size, path in entries:
+            if nbytes <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            nbytes -= size
+        self._nbytes = nbytes
+
+    def clear(self):
+        for prefix in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, prefix), ignore_errors=True)
+        self._nbytes = 0
+
+    def stats(self) -> dict:
+        entries = self.entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'bytes': sum(entry[1] for entry in entries),
+            'max_bytes': self.max_bytes,
+        }
@@ -0,0 +1,111 @@
+from itertools import product
+from typing import Optional, Sequence, Tuple
+import SimpleITK as sitk
+import numpy as np
+
+
+def index_to_physical_matrix(grid:dict) -> np.ndarray:
+    '''
+        Homogeneous (dim + 1) x (dim + 1) matrix mapping continuous indexes of `grid` to
+        physical points: direction @ diag(spacing) @ index + origin.
+    '''
+    dim = len(grid['size'])
+    matrix = np.eye(dim + 1)
+    matrix[:dim, :dim] = np.asarray(grid['direction'], dtype=float).reshape(dim, dim) * np.asarray(grid['spacing'])
+    matrix[:dim, dim] = grid['origin']
+    return matrix
+
+
+def physical_to_index_matrix(grid:dict) -> np.ndarray:
+    return np.linalg.inv(index_to_physical_matrix(grid))
+
+
+def apply_affine(matrix:np.ndarray, points:np.ndarray) -> np.ndarray:
+    '''
+        Homogeneous matrices (..., dim + 1, dim + 1) applied to points (..., n, dim).
+    '''
+    translation = matrix[..., :-1, -1]
+    if matrix.ndim > 2:
+        translation = translation[..., None, :] # one set of points per matrix
+    return points @ np.swapaxes(matrix[..., :-1, :-1], -1, -2) + translation
+
+
+def index_to_physical(grid:dict, index:np.ndarray) -> np.ndarray:
+    return apply_affine(index_to_physical_matrix(grid), np.asarray(index, dtype=float))
+
+
+def physical_to_index(grid:dict, points:np.ndarray) -> np.ndarray:
+    return apply_affine(physical_to_index_matrix(grid), np.asarray(points, dtype=float))
+
+
+def corners(grid:dict) -> np.ndarray:
+    '''
+        The 2^dim corner indexes (0 or size along every axis) of a grid.
+    '''
+    return np.asarray(list(product(*[(0, size) for size in grid['size']])), dtype=float)
+
+
+def affine_matrix(transform:sitk.Transform, dim:int=None) -> Optional[np.ndarray]:
+    '''
+        Homogeneous matrix of a linear transform (composites of linear transforms included),
+        None for a non-linear one. Matrix-offset transforms are read directly, others off the
+        images of the origin and unit points.
+    '''
+    if not transform.IsLinear():
+        return None
+    dim = dim or transform.GetDimension()
+    matrix = np.eye(dim + 1)
+    if hasattr(transform, 'GetMatrix') and hasattr(transform, 'GetCenter') and hasattr(transform, 'GetTranslation'):
+        # x -> A (x - c) + c + t
+        linear = np.reshape(transform.GetMatrix(), (dim, dim))
+        center = np.asarray(transform.GetCenter())
+        matrix[:dim, :dim] = linear
+        matrix[:dim, dim] = center + transform.GetTranslation() - linear @ center
+        return matrix
+    probes = np.vstack([np.zeros(dim), np.eye(dim)])
+    images = np.asarray([transform.TransformPoint(tuple(point)) for point in probes])
+    matrix[:dim, :dim] = (images[1:] - images[0]).T
+    matrix[:dim, dim] = images[0]
+    return matrix
+
+
+def transform_points(transform:sitk.Transform, points:np.ndarray) -> np.ndarray:
+    '''
+        Maps an (n, dim) array of physical points, as one matrix product for a linear transform.
+    '''
+    points = np.asarray(points, dtype=float)
+    matrix = affine_matrix(transform, points.shape[-1])
+    if matrix is not None:
+        return apply_affine(matrix, points)
+    return np.asarray([transform.TransformPoint(tuple(point)) for point in points])
+
+
+def output_grids(
+    grid:dict,
+    transforms:Sequence[sitk.Transform],
+    spacing:Sequence[float] = None,
+    direction:Sequence[float] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+        Sizes (n, dim) and origins (n, dim) of the grids, of `spacing` (the input's) and
+        `direction` (identity), bounding `grid` resampled by each of the `transforms` (which
+        map output points to input points). Linear transforms are handled as one batch.
+    '''
+    dim = len(grid['size'])
+    spacing = np.asarray(grid['spacing'] if spacing is None else spacing, dtype=float)
+    direction = np.eye(dim) if direction is None else np.asarray(direction, dtype=float).reshape(dim, dim)
+    points = index_to_physical(grid, corners(grid))
+    mapped = np.empty((len(transforms),) + points.shape)
+    matrices = [affine_matrix(transform, dim) for transform in transforms]
+    linear = [i for i, matrix in enumerate(matrices) if matrix is not None]
+    if linear:
+        mapped[linear] = apply_affine(np.linalg.inv(np.stack([matrices[i] for i in linear])), points)
+    for i, matrix in enumerate(matrices):
+        if matrix is None:
+            inverse = transforms[i].GetInverse()
+            mapped[i] = [inverse.TransformPoint(tuple(point)) for point in points]
+    # coordinates along the output axes
+    mapped = mapped @ direction
+    lower, upper = mapped.min(axis=1), mapped.max(axis=1)
+    sizes = ((upper - lower) / spacing).astype(int)
+    return sizes, lower @ direction.T
@@ -0,0 +1,166 @@
+from typing import Any, List, Optional, Union
+import SimpleITK as sitk
+import numpy as np
+
+from data.image import Image, Subject
+from config import numpy_dtypes
+from .utils import Composite, ResampleUtils
+from . import geometry
+from .spatial import GeometricTransform, Pad, Crop, Flip
+from .intensity import IntensityTransform, FusedIntensity, Clip
+from .random import RandomTransform
+
+
+# SimpleITK filters computing every output voxel from the same input voxel alone
+_VOXELWISE = {
+    'CastImageFilter', 'ClampImageFilter', 'ShiftScaleImageFilter', 'IntensityWindowingImageFilter',
+    'BinaryThresholdImageFilter', 'ThresholdImageFilter', 'InvertIntensityImageFilter', 'ChangeLabelImageFilter',
+    'AbsImageFilter', 'ExpImageFilter', 'LogImageFilter', 'SqrtImageFilter', 'SquareImageFilter',
+    'SigmoidImageFilter',
+}
+
+
+def voxelwise(plugin:Any) -> bool:
+    if isinstance(plugin, sitk.ImageFilter):
+        return type(plugin).__name__ in _VOXELWISE
+    if isinstance(plugin, RandomTransform):
+        return False
+    if isinstance(plugin, FusedIntensity):
+        return all(step.local for step in plugin.steps)
+    return isinstance(plugin, IntensityTransform) and plugin.local
+
+
+def _exact(plugin:Any) -> bool:
+    # moves voxels without interpolating them, so it commutes with voxel-wise steps
+    return isinstance(plugin, (Crop, Flip)) and plugin.cast is None
+
+
+def _is_identity(transform:sitk.Transform, grid:dict) -> bool:
+    if transform.GetTransformEnum() == sitk.sitkIdentity:
+        return True
+    if not transform.IsLinear():
+        return False
+    corners = geometry.index_to_physical(grid, geometry.corners(grid))
+    return np.allclose(geometry.transform_points(transform, corners), corners, rtol=0, atol=1e-3 * min(grid['spacing']))
+
+
+def _same_grid(grid:dict, other:dict) -> bool:
+    return tuple(grid['size']) == tuple(other['size']) and all(
+        np.allclose(grid[key], other[key], rtol=0, atol=1e-6) for key in ('spacing', 'origin', 'direction')
+    )
+
+
+def is_noop(plugin:Any, grid:Optional[dict]=None) -> bool:
+    '''
+        Whether a step leaves its input unchanged: zero pads and crops, flips of no axis and,
+        when the input `grid` is known, resamplings onto the same grid by an identity transform.
+    '''
+    if isinstance(plugin, (Pad, Crop)):
+        return not plugin.low.any() and not plugin.up.any()
+    if isinstance(plugin, Flip):
+        return not plugin.axes.any()
+    if grid is None or not isinstance(plugin, GeometricTransform) or not plugin.fusable or plugin.cast is not None:
+        return False
+    output, transform = plugin.geometry(grid)
+    return _same_grid(grid, output) and _is_identity(transform, grid)
+
+
+def _next_grid(plugin:Any, grid:Optional[dict]) -> Optional[dict]:
+    if grid is None:
+        return None
+    if isinstance(plugin, GeometricTransform) and plugin.fusable:
+        return plugin.geometry(grid)[0]
+    if voxelwise(plugin) or isinstance(plugin, (IntensityTransform, FusedIntensity)):
+        return grid
+    return None # unknown
+
+
+def _cast_type(plugin:Any) -> Optional[int]:
+    if isinstance(plugin, sitk.CastImageFilter):
+        return plugin.GetOutputPixelType()
+    return None
+
+
+def _clip_with_cast(clip:Clip, pixel_id:int, before:bool) -> Optional[Clip]:
+    if clip.cast is not None or clip.keys is not None or pixel_id not in numpy_dtypes:
+        return None
+    if before:
+        # cast-then-clip equals clip-then-cast when the bounds are values of the cast type
+        dtype = np.dtype(numpy_dtypes[pixel_id])
+        limits = np.iinfo(dtype) if dtype.kind in 'iu' else np.finfo(dtype)
+        if not all(limits.min <= bound <= limits.max and dtype.type(bound) == bound for bound in (clip.low, clip.up)):
+            return None
+    return Clip(clip.low, clip.up, pixel_id)
+
+
+def optimize(plugins:List[Any], grid:dict=None) -> List[Any]:
+    '''
+        Rewrites a pipeline into an equivalent, cheaper one:
+            - drops steps leaving their input unchanged (see `is_noop`), `grid` being the input's,
+            - moves crops and flips before the voxel-wise steps preceding them, so they shrink
+              their work and get next to the resamplings they can be fused into,
+            - folds a cast next to a clip into the clip,
+        then fuses what can be (see `Composite.fuse`).
+    '''
+    kept = []
+    for plugin in plugins:
+        if not is_noop(plugin, grid):
+            kept.append(plugin)
+        grid = _next_grid(plugin, grid)
+
+    ordered = []
+    for plugin in kept:
+        position = len(ordered)
+        while _exact(plugin) and position and voxelwise(ordered[position - 1]):
+            position -= 1
+        ordered.insert(position, plugin)
+
+    folded = []
+    for plugin in ordered:
+        previous = folded[-1] if folded else None
+        merged = None
+        if isinstance(previous, Clip) and _cast_type(plugin) is not None:
+            merged = _clip_with_cast(previous, _cast_type(plugin), before=False)
+        elif isinstance(plugin, Clip) and _cast_type(previous) is not None:
+            merged = _clip_with_cast(plugin, _cast_type(previous), before=True)
+        if merged is None:
+            folded.append(plugin)
+        else:
+            folded[-1] = merged
+    return Composite(folded).fuse().composite
+
+
+def input_grid(image:Union[sitk.Image, Image, Subject]) -> Optional[dict]:
+    '''
+        Grid of an input (read from the header of a lazy image), None for a Subject whose
+        images don't share one.
+    '''
+    images = list(image.images.values()) if isinstance(image, Subject) else [image]
+    grids = [ResampleUtils.grid(value) for value in images]
+    return grids[0] if grids and all(_same_grid(grids[0], grid) for grid in grids[1:]) else None
+
+
+class Deferred:
+    '''
+        Pipeline steps applied to an input but not run yet, returned by `Composite(...,
+        lazy=True)`. Lazy composites called on it add their steps; the whole chain is
+        optimized (see `optimize`) and run when the output is requested with `compute`.
+    '''
+    def __init__(self, source:Union[sitk.Image, Image, Subject], plugins:List[Any], cache=None,
+                 profiler=None) -> None:
+        self.source = source
+        self.plugins = plugins
+        self.cache = cache
+        self.profiler = profiler
+
+    def then(self, plugins:List[Any], cache=None, profiler=None) -> 'Deferred':
+        return Deferred(self.source, self.plugins + list(plugins), cache or self.cache, profiler or self.profiler)
+
+    def plan(self) -> List[Any]:
+        return optimize(self.plugins, input_grid(self.source))
+
+    def compute(self) -> Union[Image, Subject]:
+        return Composite(self.plan(), self.cache, self.profiler)(self.source)
+
+    def __repr__(self):
+        return f"Deferred({len(self.plugins)} steps)"
@@ -1,12 +1,204 @@
 import SimpleITK as sitk
 import numpy as np
-from typing import Tuple, Union
+from typing import List, Sequence, Tuple, Union
 
 from data.image import Image, Subject
 from .utils import Transform
+from config import ImageType, DataType, numpy_dtypes
 
 
-class Clip(Transform):
+def _integer_histogram(array:np.ndarray, chunk:int=2**20) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+        (values, counts) of an integer array, counted chunk by chunk so no full-size temporary
+        is made. None when the value range is too wide for a histogram.
+    '''
+    flat = array.reshape(-1)
+    if array.dtype.itemsize <= 2:
+        # 8/16 bit: the raw bits index the histogram, signed values shifted by flipping the sign bit
+        unsigned = np.dtype('u%d' % array.dtype.itemsize)
+        sign = unsigned.type(1 << (8 * array.dtype.itemsize - 1)) if array.dtype.kind == 'i' else unsigned.type(0)
+        counts = np.zeros(1 << (8 * array.dtype.itemsize), dtype=np.int64)
+        for start in range(0, flat.size, chunk):
+            counts += np.bincount(flat[start:start + chunk].view(unsigned) ^ sign, minlength=len(counts))
+        values = np.arange(len(counts), dtype=np.int64) - int(sign)
+    else:
+        low, up = int(flat.min()), int(flat.max())
+        if up - low >= 2**24:
+            return None
+        counts = np.zeros(up - low + 1, dtype=np.int64)
+        for start in range(0, flat.size, chunk):
+            counts += np.bincount(flat[start:start + chunk].astype(np.int64) - low, minlength=len(counts))
+        values = np.arange(low, up + 1, dtype=np.int64)
+    nonzero = counts > 0
+    return values[nonzero], counts[nonzero]
+
+
+def _histogram_percentile(values:np.ndarray, counts:np.ndarray, q:np.ndarray) -> np.ndarray:
+    cumulative = np.cumsum(counts)
+    position = q / 100 * (cumulative[-1] - 1)
+    lower = np.floor(position)
+    below = values[np.searchsorted(cumulative, lower, side='right')]
+    above = values[np.searchsorted(cumulative, np.minimum(lower + 1, cumulative[-1] - 1), side='right')]
+    return below + (position - lower) * (above - below)
+
+
+def percentile(array:np.ndarray, q:Union[float, Sequence[float]], max_samples:int=None) -> np.ndarray:
+    '''
+        Same as `np.percentile(array, q)` (linear interpolation). Integer arrays are answered
+        exactly from a histogram; other arrays are subsampled with a stride to about
+        `max_samples` voxels when given, which makes the result approximate.
+    '''
+    q = np.asarray(q, dtype=np.float64)
+    histogram = _integer_histogram(array) if array.dtype.kind in 'iu' else None
+    if histogram is None:
+        flat = array.reshape(-1)
+        if max_samples is not None and flat.size > max_samples:
+            flat = flat[::int(np.ceil(flat.size / max_samples))]
+        return np.percentile(flat, q)
+    return _histogram_percentile(*histogram, q)
+
+
+class _Statistics:
+    '''
+        Statistics of a voxel array, each computed once when first asked for. Integer arrays
+        get them all from one histogram scan.
+    '''
+    def __init__(self, array:np.ndarray, max_samples:int=None, chunk:int=2**20) -> None:
+        self.flat = array.reshape(-1)
+        self.max_samples = max_samples
+        self.chunk = chunk
+        self.histogram = _integer_histogram(array) if array.dtype.kind in 'iu' else None
+        self._range = None
+
+    @classmethod
+    def from_histogram(cls, values:np.ndarray, counts:np.ndarray) -> '_Statistics':
+        statistics = cls(np.empty(0, dtype=np.int8))
+        statistics.histogram = values, counts
+        return statistics
+
+    def range(self) -> Tuple[float, float]:
+        if self._range is None:
+            if self.histogram is not None:
+                self._range = float(self.histogram[0][0]), float(self.histogram[0][-1])
+            else:
+                self._range = float(self.flat.min()), float(self.flat.max())
+        return self._range
+
+    def percentile(self, q:Sequence[float], low:float=-np.inf, up:float=np.inf) -> np.ndarray:
+        '''
+            Percentiles of the voxels clipped to [low, up], exact unless `max_samples` subsamples
+            a non-integer image.
+        '''
+        q = np.asarray(q, dtype=np.float64)
+        if self.histogram is not None:
+            values, counts = self.histogram
+            return _histogram_percentile(np.clip(values, low, up), counts, q)
+        if np.isinf(low) and np.isinf(up):
+            return percentile(self.flat, q, self.max_samples)
+        flat = self.flat
+        if self.max_samples is not None and flat.size > self.max_samples:
+            flat = flat[::int(np.ceil(flat.size / self.max_samples))]
+        # the two voxels a percentile interpolates between, clipped before interpolating
+        position = q / 100 * (flat.size - 1)
+        below = np.clip(np.percentile(flat, q, method='lower'), low, up)
+        above = np.clip(np.percentile(flat, q, method='higher'), low, up)
+        return below + (position - np.floor(position)) * (above - below)
+
+    def rounded(self, mapping:'_IntensityMap', dtype:np.dtype) -> '_Statistics':
+        '''
+            Statistics of the voxels mapped by `mapping` into an integer `dtype`, from the histogram.
+        '''
+        values, inverse = np.unique(mapping(self.histogram[0]).astype(dtype), return_inverse=True)
+        return _Statistics.from_histogram(values, np.bincount(inverse, self.histogram[1]).astype(np.int64))
+
+    def moments(self, low:float, up:float) -> Tuple[float, float]:
+        '''
+            Mean and (unbiased) standard deviation of the voxels clipped to [low, up].
+        '''
+        if self.histogram is not None:
+            values, counts = self.histogram
+            values = np.clip(values, low, up)
+            mean = (values * counts).sum() / counts.sum()
+            return mean, np.sqrt(((values - mean) ** 2 * counts).sum() / max(counts.sum() - 1, 1))
+        # chunk statistics merged with Chan's parallel update, stable on large volumes
+        n, mean, m2 = 0, 0., 0.
+        for start in range(0, self.flat.size, self.chunk):
+            values = np.clip(self.flat[start:start + self.chunk], low, up, dtype=np.float64)
+            count, chunk_mean = len(values), values.mean()
+            delta = chunk_mean - mean
+            mean += delta * count / (n + count)
+            m2 += ((values - chunk_mean) ** 2).sum() + delta ** 2 * n * count / (n + count)
+            n += count
+        return mean, np.sqrt(m2 / max(n - 1, 1))
+
+
+class _IntensityMap:
+    '''
+        Monotone voxel mapping y = scale * clip(x, low, up) + shift; a chain of clips and
+        affine maps always folds into one.
+    '''
+    def __init__(self, scale:float=1., shift:float=0., low:float=-np.inf, up:float=np.inf) -> None:
+        self.scale, self.shift, self.low, self.up = scale, shift, low, up
+
+    def __call__(self, x):
+        return self.scale * np.clip(x, self.low, self.up) + self.shift
+
+    def affine(self, scale:float, shift:float) -> '_IntensityMap':
+        return _IntensityMap(self.scale * scale, self.shift * scale + shift, self.low, self.up)
+
+    def clip(self, low:float, up:float) -> '_IntensityMap':
+        if self.scale == 0:
+            return _IntensityMap(0., float(np.clip(self.shift, low, up)))
+        bounds = sorted(((low - self.shift) / self.scale, (up - self.shift) / self.scale))
+        new_low, new_up = max(self.low, bounds[0]), min(self.up, bounds[1])
+        if new_low > new_up:
+            # every voxel lands on one side of the window
+            return _IntensityMap(0., float(np.clip(self(self.low if np.isfinite(self.low) else self.up), low, up)))
+        return _IntensityMap(self.scale, self.shift, new_low, new_up)
+
+    def range(self, statistics:_Statistics) -> Tuple[float, float]:
+        return tuple(sorted(self(np.asarray(statistics.range()))))
+
+    def percentile(self, statistics:_Statistics, q:Sequence[float]) -> np.ndarray:
+        q = np.asarray(q, dtype=np.float64)
+        return self(statistics.percentile(q if self.scale >= 0 else 100 - q, self.low, self.up))
+
+    def moments(self, statistics:_Statistics) -> Tuple[float, float]:
+        mean, std = statistics.moments(self.low, self.up)
+        return self.scale * mean + self.shift, abs(self.scale) * std
+
+    def apply(self, array:np.ndarray, out:np.ndarray, chunk:int=2**20):
+        # chunked, so the only full-size buffer is `out`
+        wide = np.float64 if max(array.dtype.itemsize, out.dtype.itemsize) > 4 else np.float32
+        flat, flat_out = array.reshape(-1), out.reshape(-1)
+        temp = np.empty(min(chunk, flat.size), dtype=wide)
+        for start in range(0, flat.size, chunk):
+            values = temp[:len(flat[start:start + chunk])]
+            np.clip(flat[start:start + chunk], self.low, self.up, out=values)
+            values *= self.scale
+            values += self.shift
+            flat_out[start:start + chunk] = values
+
+
+class IntensityTransform(Transform):
+    '''
+        A transform mapping every voxel through a monotone function of its value and of the
+        image statistics, so that consecutive ones can be fused into one pass over the voxels
+        (see `fuse_intensity`). `cast` is the output pixel type, None keeps it.
+    '''
+    cast = None
+    local = False # True when the result doesn't depend on image statistics
+
+    def fold(self, mapping:_IntensityMap, statistics:_Statistics) -> _IntensityMap:
+        raise NotImplementedError
+
+    def output_type(self, pixel_id:int) -> int:
+        return pixel_id if self.cast is None else self.cast
+
+
+class Clip(IntensityTransform):
+    local = True
+
     def __init__(self, low:float=-1000, up:float=1000, cast=None, transform_keys:Tuple[str]=None) -> None:
         super().__init__(transform_keys)
         clip_filter = sitk.ClampImageFilter()
@@ -15,24 +207,31 @@ class Clip(Transform):
         if cast is not None:
             clip_filter.SetOutputPixelType(cast)
         self.total_filter.append(clip_filter)
+        self.low, self.up, self.cast = low, up, cast
+
+    def fold(self, mapping, statistics):
+        return mapping.clip(self.low, self.up)
 
 def clip(image:Union[sitk.Image, Image, Subject], low:float=-1000, up:float=1000, 
          cast=None, transform_keys:Tuple[str]=None):
     return Clip(low, up, cast, transform_keys)(image)
 
 
-class Rescale(Transform):
+class Rescale(IntensityTransform):
     def __init__(self, out_min=0, out_max=255, 
                  percentiles: Tuple[float, float] = (0, 100), 
-                 cast=None, transform_keys:Tuple[str]=None) -> None:
+                 cast=None, transform_keys:Tuple[str]=None, max_samples:int=None) -> None:
         super().__init__(transform_keys)
         self.percentiles = percentiles
+        self.max_samples = max_samples
+        self.out_min, self.out_max, self.cast = out_min, out_max, cast
         rescale_filter = sitk.RescaleIntensityImageFilter()
         rescale_filter.SetOutputMaximum(out_max)
         rescale_filter.SetOutputMinimum(out_min)
         self.total_filter.append(rescale_filter)
 
-        if cast is not None:
+        if cast is not None and _is_integer(cast):
+            # a cast to a floating type is done first instead (see `_rescale`)
             cast_filter = sitk.CastImageFilter()
             cast_filter.SetOutputPixelType(cast)
             self.total_filter.append(cast_filter)
@@ -46,21 +245,134 @@ class Rescale(Transform):
             return super().__call__(subj)
 
     def _rescale(self, image: Union[Image, sitk.Image]):
-        array = sitk.GetArrayFromImage(image)
-        cutoff = np.percentile(array.ravel(), self.percentiles)
-        np.clip(array, *cutoff, out=array)
-        return sitk.GetImageFromArray(array).CopyInformation(image)
+        low = up = None
+        if tuple(self.percentiles) != (0, 100):
+            view = image.view if isinstance(image, Image) else sitk.GetArrayViewFromImage(image)
+            low, up = percentile(view, self.percentiles, self.max_samples)
+        if self.cast is not None and not _is_integer(self.cast):
+            # rescaled in the output type, not rounded into an integer input type first
+            image = Image(sitk.Cast(image, self.cast), type=getattr(image, 'type', ImageType.Scalar))
+        if low is None:
+            return image
+        # clamping writes the output buffer in one pass, the input is never copied
+        clip_filter = sitk.ClampImageFilter()
+        clip_filter.SetLowerBound(float(low))
+        clip_filter.SetUpperBound(float(up))
+        return Image(clip_filter.Execute(image), type=getattr(image, 'type', ImageType.Scalar))
+
+    def fold(self, mapping, statistics):
+        if tuple(self.percentiles) != (0, 100):
+            mapping = mapping.clip(*mapping.percentile(statistics, self.percentiles))
+        low, up = mapping.range(statistics)
+        # same scale as itk::RescaleIntensityImageFilter, including constant images
+        if low != up:
+            scale = (self.out_max - self.out_min) / (up - low)
+        else:
+            scale = (self.out_max - self.out_min) / up if up != 0 else 0.
+        return mapping.affine(scale, self.out_min - low * scale)
 
 def rescale(image:Union[sitk.Image, Image, Subject], out_min=0, out_max=255, 
             percentiles: Tuple[float, float] = (0, 100), cast=None, 
-            transform_keys:Tuple[str]=None):
-    return Rescale(out_min, out_max, percentiles, cast, transform_keys)(image)
+            transform_keys:Tuple[str]=None, max_samples:int=None):
+    return Rescale(out_min, out_max, percentiles, cast, transform_keys, max_samples)(image)
 
 
-class Normalize(Transform):
+class Normalize(IntensityTransform):
     def __init__(self, transform_keys:Tuple[str]=None) -> None:
         super().__init__(transform_keys)
         self.total_filter.append(sitk.NormalizeImageFilter())
 
+    def fold(self, mapping, statistics):
+        mean, std = mapping.moments(statistics)
+        scale = 1 / std if std > 0 else 0.
+        return mapping.affine(scale, -mean * scale)
+
+    def output_type(self, pixel_id):
+        return DataType.Float64
+
 def normalize(image:Union[sitk.Image, Image, Subject], transform_keys:Tuple[str]=None):
-    return Normalize(transform_keys)(image)
\ No newline at end of file
+    return Normalize(transform_keys)(image)
+
+
+class FusedIntensity(Transform):
+    '''
+        Runs a chain of intensity transforms as one pass: the statistics they need are taken
+        from the input (one histogram scan for integer images), their clips and affine maps
+        are folded into one mapping and written straight into an output buffer of the final
+        pixel type. Where the step-by-step chain would round voxels into an integer pixel type
+        before a later step, that intermediate image is written too and the rest of the chain
+        goes on from it, so both give the same output.
+    '''
+    def __init__(self, steps:List[IntensityTransform], transform_keys:Tuple[str]=None, max_samples:int=None,
+                 statistics:_Statistics=None) -> None:
+        super().__init__(transform_keys)
+        self.steps = steps
+        self.max_samples = max_samples
+        # fixed statistics (e.g. of a whole volume processed by slabs) instead of the input's
+        self._statistics = statistics
+
+    def __call__(self, image:Union[sitk.Image, Image, Subject]):
+        if isinstance(image, Subject):
+            return self._subject_apply(image, self._apply)
+        return self._apply(image)
+
+    def _apply(self, image:Union[sitk.Image, Image], statistics:_Statistics=None):
+        if image.GetNumberOfComponentsPerPixel() > 1:
+            for step in self.steps:
+                image = step(image)
+            return image
+        view = image.view if isinstance(image, Image) else sitk.GetArrayViewFromImage(image)
+        statistics = statistics or self._statistics or _Statistics(view, self.max_samples)
+        mapping, pixel_id = _IntensityMap(), image.GetPixelID()
+        for index, step in enumerate(self.steps):
+            mapping = step.fold(mapping, statistics)
+            exact = _keeps_integers(step, pixel_id)
+            pixel_id = step.output_type(pixel_id)
+            if index < len(self.steps) - 1 and _is_integer(pixel_id) and not exact:
+                # the step-by-step chain rounds here, the rest goes on from the rounded image
+                rest = FusedIntensity(self.steps[index + 1:], self.keys, self.max_samples)
+                rounded = None if statistics.histogram is None or self._statistics is None \
+                    else statistics.rounded(mapping, numpy_dtypes[pixel_id])
+                return rest._apply(self._write(image, view, mapping, pixel_id), rounded)
+        return self._write(image, view, mapping, pixel_id)
+
+    @staticmethod
+    def _write(image:Union[sitk.Image, Image], view:np.ndarray, mapping:_IntensityMap, pixel_id:int) -> Image:
+        output = Image(sitk.Image(image.GetSize(), pixel_id), type=getattr(image, 'type', ImageType.Scalar))
+        output.CopyInformation(image)
+        mapping.apply(view, output.buffer())
+        return output
+
+
+def _is_integer(pixel_id:int) -> bool:
+    return pixel_id in numpy_dtypes and np.dtype(numpy_dtypes[pixel_id]).kind in 'iu'
+
+
+def _keeps_integers(step:IntensityTransform, pixel_id:int) -> bool:
+    # clipping integers to integer bounds needs no rounding
+    return isinstance(step, Clip) and _is_integer(pixel_id) and all(
+        not np.isfinite(bound) or float(bound).is_integer() for bound in (step.low, step.up)
+    )
+
+
+def _fusable_with(run:List[IntensityTransform], plugin:IntensityTransform) -> bool:
+    return plugin.keys == run[0].keys and run[-1].cast is None
+
+
+def fuse_intensity(plugins:List) -> List:
+    '''
+        Replaces every run of consecutive intensity transforms (Clip, Rescale, Normalize) by
+        one `FusedIntensity`. A cast ends a run, only the last step of a run may change the type.
+    '''
+    fused, run = [], []
+    for plugin in plugins + [None]:
+        fusable = isinstance(plugin, IntensityTransform)
+        if run and not (fusable and _fusable_with(run, plugin)):
+            max_samples = max((getattr(step, 'max_samples', None) or 0 for step in run), default=0) or None
+            fused.append(FusedIntensity(run, run[0].keys, max_samples) if len(run) > 1 else run[0])
+            run = []
+        if fusable:
+            run.append(plugin)
+        elif plugin is not None:
+            fused.append(plugin)
+    return fused
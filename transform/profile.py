@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import threading
+import tracemalloc
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List
+import SimpleITK as sitk
+
+from data.image import Image, Subject
+from data.cache import image_nbytes
+
+
+def step_name(plugin:Any) -> str:
+    if isinstance(plugin, sitk.ImageFilter):
+        return plugin.GetName()
+    return type(plugin).__name__
+
+
+def _images(value:Any) -> List[sitk.Image]:
+    if isinstance(value, Subject):
+        return list(value.images.values())
+    return [value] if isinstance(value, sitk.Image) else []
+
+
+def _nbytes(value:Any) -> int:
+    # a lazy image isn't read just to be measured
+    return sum(image_nbytes(image) for image in _images(value) if getattr(image, 'is_loaded', True))
+
+
+def _pixel_types(value:Any) -> str:
+    return ', '.join(sorted({image.GetPixelIDTypeAsString() for image in _images(value)}))
+
+
+def _rss() -> int:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class _PeakMemory:
+    '''
+        Peak memory allocated while the block runs. SimpleITK allocates outside of Python,
+        so the resident set size is polled when /proc is available; elsewhere only Python and
+        numpy allocations are seen through tracemalloc.
+    '''
+    def __init__(self, interval:float=1e-3) -> None:
+        self.interval = interval
+        self.peak = 0
+
+    def __enter__(self):
+        self.proc = os.path.exists('/proc/self/statm')
+        if self.proc:
+            self.start = self.high = _rss()
+            self.done = threading.Event()
+            self.thread = threading.Thread(target=self._poll, daemon=True)
+            self.thread.start()
+        else:
+            self.tracing = tracemalloc.is_tracing()
+            if not self.tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self.start = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def _poll(self):
+        while not self.done.wait(self.interval):
+            self.high = max(self.high, _rss())
+
+    def __exit__(self, *exc):
+        if self.proc:
+            self.done.set()
+            self.thread.join()
+            self.peak = max(self.high, _rss()) - self.start
+        else:
+            self.peak = tracemalloc.get_traced_memory()[1] - self.start
+            if not self.tracing:
+                tracemalloc.stop()
+
+
+class Profiler:
+    '''
+        Collects, per step of a Composite (`Composite(..., profiler=Profiler())`), wall and CPU
+        time, input and output bytes, output pixel types and peak allocated bytes, summed over
+        calls. Results are available as a table, as JSON or as a Chrome trace
+        (chrome://tracing, Perfetto).
+    '''
+    def __init__(self, memory:bool=True) -> None:
+        self.memory = memory
+        self.steps = OrderedDict()
+        self.events = []
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def run(self, index:int, plugin:Any, run:Callable, image:Any) -> Any:
+        name = step_name(plugin)
+        in_bytes = _nbytes(image)
+        peak = _PeakMemory() if self.memory else None
+        start, cpu = time.perf_counter(), time.process_time()
+        if peak is not None:
+            with peak:
+                output = run(plugin, image)
+        else:
+            output = run(plugin, image)
+        wall, cpu = time.perf_counter() - start, time.process_time() - cpu
+        self.record(index, name, start, wall, cpu, in_bytes, _nbytes(output), _pixel_types(output),
+                    peak.peak if peak is not None else None)
+        return output
+
+    def record(self, index:int, name:str, start:float, wall:float, cpu:float, in_bytes:int=0,
+               out_bytes:int=0, pixel_type:str='', peak:int=None):
+        with self.lock:
+            step = self.steps.setdefault((index, name), {
+                'index': index, 'name': name, 'calls': 0, 'wall': 0., 'max_wall': 0., 'cpu': 0.,
+                'in_bytes': 0, 'out_bytes': 0, 'peak_bytes': 0, 'pixel_types': set(),
+            })
+            step['calls'] += 1
+            step['wall'] += wall
+            step['max_wall'] = max(step['max_wall'], wall)
+            step['cpu'] += cpu
+            step['in_bytes'] += in_bytes
+            step['out_bytes'] += out_bytes
+            step['peak_bytes'] = max(step['peak_bytes'], peak or 0)
+            if pixel_type:
+                step['pixel_types'].add(pixel_type)
+            self.events.append({
+                'name': name, 'cat': 'transform', 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                'ts': (start - self.origin) * 1e6, 'dur': wall * 1e6,
+                'args': {'step': index, 'cpu_ms': cpu * 1e3, 'in_bytes': in_bytes, 'out_bytes': out_bytes,
+                         'peak_bytes': peak, 'pixel_type': pixel_type},
+            })
+
+    def summary(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            total = sum(step['wall'] for step in self.steps.values()) or 1.
+            return [
+                dict(step, pixel_types=sorted(step['pixel_types']), share=step['wall'] / total,
+                     mean_wall=step['wall'] / step['calls'])
+                for step in sorted(self.steps.values(), key=lambda step: step['index'])
+            ]
+
+    def table(self) -> str:
+        rows = [('#', 'step', 'calls', 'wall s', 'mean s', 'share', 'cpu s', 'in MB', 'out MB', 'peak MB', 'type')]
+        for step in self.summary():
+            rows.append((
+                str(step['index']), step['name'], str(step['calls']), '%.3f' % step['wall'],
+                '%.3f' % step['mean_wall'], '%.1f%%' % (100 * step['share']), '%.3f' % step['cpu'],
+                '%.1f' % (step['in_bytes'] / step['calls'] / 2**20), '%.1f' % (step['out_bytes'] / step['calls'] / 2**20),
+                '%.1f' % (step['peak_bytes'] / 2**20), ', '.join(step['pixel_types'])
+            ))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows)
+
+    def to_json(self, path:str=None) -> str:
+        text = json.dumps(self.summary(), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def chrome_trace(self, path:str):
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def reset(self):
+        with self.lock:
+            self.steps.clear()
+            self.events.clear()
+            self.origin = time.perf_counter()
+
+    def __str__(self):
+        return self.table()
@@ -0,0 +1,336 @@
+import os
+import itertools
+from typing import List, Sequence, Tuple, Union
+import SimpleITK as sitk
+import numpy as np
+from torch.utils.data import get_worker_info
+
+from data.image import Image, Subject
+from .utils import Transform, ResampleUtils
+from config import DataType, ImageType, InterpolatorType
+
+
+def _range(value:Union[float, Tuple[float, float]], center:float=0.) -> Tuple[float, float]:
+    # a number x means center +- x
+    if np.isscalar(value):
+        return center - value, center + value
+    return tuple(value)
+
+
+class RandomTransform(Transform):
+    '''
+        Base of the random augmentations. Parameters are drawn on every call from a generator
+        seeded with `seed`; inside a DataLoader worker the worker's seed is mixed in, so
+        every worker (and every epoch) gets its own stream.
+    '''
+    deterministic = False
+
+    def __init__(self, p:float=1., seed:int=None, transform_keys:Tuple[str]=None) -> None:
+        super().__init__(transform_keys)
+        self.p = p
+        self.seed = seed
+        self._rng = None
+        self._rng_owner = None
+
+    @property
+    def rng(self) -> np.random.Generator:
+        worker = get_worker_info()
+        owner = (os.getpid(), None if worker is None else worker.seed)
+        if self._rng is None or self._rng_owner != owner:
+            entropy = ([] if self.seed is None else [self.seed]) + ([] if worker is None else [worker.seed])
+            self._rng = np.random.default_rng(np.random.SeedSequence(entropy) if entropy else None)
+            self._rng_owner = owner
+        return self._rng
+
+    def _images(self, image:Union[sitk.Image, Image, Subject]) -> List[Union[sitk.Image, Image]]:
+        if not isinstance(image, Subject):
+            return [image]
+        keys = tuple(image.keys()) if self.keys is None else self.keys
+        return [value for name, value in image.images.items() if name in keys]
+
+
+class RandomSpatialTransform(RandomTransform):
+    '''
+        A random spatial transform: `sample` draws a transform (output to input physical
+        points) for one sample, every image of a Subject is resampled once on it, labels
+        with nearest neighbour.
+    '''
+    def __init__(self, p:float=1., interpolator:int=InterpolatorType.Linear, default_value:float=0,
+                 seed:int=None, transform_keys:Tuple[str]=None) -> None:
+        super().__init__(p, seed, transform_keys)
+        self.interpolator = interpolator
+        self.default_value = default_value
+
+    def sample(self, image:Union[sitk.Image, Image], rng:np.random.Generator) -> sitk.Transform:
+        raise NotImplementedError
+
+    def __call__(self, image:Union[sitk.Image, Image, Subject]):
+        rng = self.rng
+        images = self._images(image)
+        if not images or rng.random() >= self.p:
+            return image
+        transform = self.sample(images[0], rng)
+        if transform is None:
+            return image
+        if isinstance(image, Subject):
+            return self._subject_apply(image, lambda value: self._resample(value, transform))
+        return self._resample(image, transform)
+
+    def _resample(self, image:Union[sitk.Image, Image], transform:sitk.Transform):
+        type = getattr(image, 'type', ImageType.Scalar)
+        label = type == ImageType.Label
+        resample_filter = ResampleUtils.resample_filter(
+            ResampleUtils.grid(image), transform,
+            InterpolatorType.NearestNeighbor if label else self.interpolator, 0 if label else self.default_value
+        )
+        return Image(resample_filter.Execute(image), type=type)
+
+    @staticmethod
+    def _center(image:Union[sitk.Image, Image]) -> np.ndarray:
+        return ResampleUtils.index_to_physical(ResampleUtils.grid(image), (np.asarray(image.GetSize()) - 1) / 2)
+
+
+class RandomAffine(RandomSpatialTransform):
+    '''
+        Rotation by up to `degrees` around every axis, scaling by 1 +- `scales` (the same on
+        every axis when `isotropic`) and translation by up to `translation` mm, about the
+        image center.
+    '''
+    def __init__(self, degrees:Union[float, Tuple[float, float]]=10, scales:Union[float, Tuple[float, float]]=0.1,
+                 translation:Union[float, Tuple[float, float]]=0, isotropic:bool=False, p:float=1.,
+                 interpolator:int=InterpolatorType.Linear, default_value:float=0,
+                 seed:int=None, transform_keys:Tuple[str]=None) -> None:
+        super().__init__(p, interpolator, default_value, seed, transform_keys)
+        self.degrees = _range(degrees)
+        self.scales = _range(scales, 1.)
+        self.translation = _range(translation)
+        self.isotropic = isotropic
+
+    def sample(self, image, rng):
+        dim = image.GetDimension()
+        angles = np.radians(rng.uniform(*self.degrees, size=1 if dim == 2 else 3))
+        scales = rng.uniform(*self.scales, size=1 if self.isotropic else dim) * np.ones(dim)
+        if dim == 2:
+            rotation = sitk.Euler2DTransform((0, 0), float(angles[0])).GetMatrix()
+        else:
+            rotation = sitk.Euler3DTransform((0, 0, 0), *map(float, angles)).GetMatrix()
+        matrix = np.asarray(rotation).reshape(dim, dim) * scales
+
+        transform = sitk.AffineTransform(dim)
+        transform.SetMatrix(matrix.ravel().tolist())
+        transform.SetCenter(self._center(image).tolist())
+        transform.SetTranslation(rng.uniform(*self.translation, size=dim).tolist())
+        return transform
+
+
+class RandomElastic(RandomSpatialTransform):
+    '''
+        Smooth deformation from a coarse cubic B-spline grid of `num_control_points` per axis,
+        whose inner control points move by up to `max_displacement` mm.
+    '''
+    def __init__(self, num_control_points:Union[int, Sequence[int]]=7, max_displacement:float=7.5, p:float=1.,
+                 interpolator:int=InterpolatorType.Linear, default_value:float=0,
+                 seed:int=None, transform_keys:Tuple[str]=None) -> None:
+        super().__init__(p, interpolator, default_value, seed, transform_keys)
+        self.num_control_points = num_control_points
+        self.max_displacement = max_displacement
+
+    def sample(self, image, rng):
+        dim = image.GetDimension()
+        points = np.broadcast_to(self.num_control_points, (dim,)).astype(int)
+        transform = sitk.BSplineTransformInitializer(image, (points - 3).tolist())
+        # coefficients are stored per axis, x fastest
+        displacement = rng.uniform(-1, 1, size=(dim,) + tuple(points[::-1])) * self.max_displacement
+        for axis in range(1, dim + 1):
+            index = [slice(None)] * (dim + 1)
+            index[axis] = [0, -1]
+            displacement[tuple(index)] = 0
+        transform.SetParameters(displacement.ravel().tolist())
+        return transform
+
+
+class RandomFlip(RandomSpatialTransform):
+    '''
+        Flips the voxels along every axis of `axes` (x, y, z order) with probability `p`.
+    '''
+    def __init__(self, axes:Sequence[int]=(0,), p:float=0.5, seed:int=None, transform_keys:Tuple[str]=None) -> None:
+        super().__init__(1., InterpolatorType.NearestNeighbor, 0, seed, transform_keys)
+        self.axes = tuple(axes)
+        self.flip_probability = p
+
+    def sample(self, image, rng):
+        dim = image.GetDimension()
+        signs = np.ones(dim)
+        for axis in self.axes:
+            if rng.random() < self.flip_probability:
+                signs[axis] = -1
+        if np.all(signs == 1):
+            return None
+        # a reflection about the image center along the image axes maps voxels onto voxels
+        direction = np.asarray(image.GetDirection()).reshape(dim, dim)
+        transform = sitk.AffineTransform(dim)
+        transform.SetMatrix((direction @ np.diag(signs) @ direction.T).ravel().tolist())
+        transform.SetCenter(self._center(image).tolist())
+        return transform
+
+
+class RandomSpatial(RandomSpatialTransform):
+    '''
+        Draws every transform of `steps` for a sample and composes them, so the sample is
+        resampled once however many spatial augmentations are chained.
+    '''
+    def __init__(self, steps:List[RandomSpatialTransform], interpolator:int=None, default_value:float=None,
+                 seed:int=None, transform_keys:Tuple[str]=None) -> None:
+        interpolator = next((step.interpolator for step in steps if not isinstance(step, RandomFlip)), InterpolatorType.Linear) \
+            if interpolator is None else interpolator
+        default_value = steps[0].default_value if default_value is None else default_value
+        super().__init__(1., interpolator, default_value, seed, transform_keys)
+        self.steps = steps
+
+    def sample(self, image, rng):
+        transforms = []
+        for step in self.steps:
+            if rng.random() < step.p:
+                transform = step.sample(image, rng)
+                if transform is not None:
+                    transforms.append(transform)
+        if not transforms:
+            return None
+        # the first augmentation is applied first, so its transform maps the last
+        return transforms[0] if len(transforms) == 1 else sitk.CompositeTransform(transforms)
+
+
+class RandomIntensityTransform(RandomTransform):
+    '''
+        A random voxel-wise augmentation of the scalar images (labels are left untouched).
+        `sample` draws the parameters shared by the images of one sample.
+    '''
+    def sample(self, rng:np.random.Generator):
+        return None
+
+    def __call__(self, image:Union[sitk.Image, Image, Subject]):
+        rng = self.rng
+        if rng.random() >= self.p:
+            return image
+        parameters = self.sample(rng)
+        apply = lambda value: value if getattr(value, 'type', ImageType.Scalar) == ImageType.Label \
+            else self._apply(value, parameters, rng)
+        if isinstance(image, Subject):
+            return self._subject_apply(image, apply)
+        return apply(image)
+
+    def _apply(self, image:Union[sitk.Image, Image], parameters, rng:np.random.Generator):
+        raise NotImplementedError
+
+    @staticmethod
+    def _output(image:Union[sitk.Image, Image]) -> Tuple[Image, np.ndarray, np.ndarray]:
+        # float32 output written in place, the input voxels are only read
+        view = image.view if isinstance(image, Image) else sitk.GetArrayViewFromImage(image)
+        output = Image(
+            sitk.Image(image.GetSize(), DataType.Float32 if image.GetNumberOfComponentsPerPixel() == 1
+                       else DataType.VectorFloat32, image.GetNumberOfComponentsPerPixel()),
+            type=getattr(image, 'type', ImageType.Scalar)
+        )
+        output.CopyInformation(image)
+        buffer = output.buffer()
+        buffer[...] = view
+        return output, buffer, view
+
+
+class RandomGamma(RandomIntensityTransform):
+    '''
+        Gamma correction with gamma = exp(u), u drawn from `log_gamma`, on intensities
+        rescaled to [0, 1] and mapped back.
+    '''
+    def __init__(self, log_gamma:Union[float, Tuple[float, float]]=0.3, p:float=1.,
+                 seed:int=None, transform_keys:Tuple[str]=None) -> None:
+        super().__init__(p, seed, transform_keys)
+        self.log_gamma = _range(log_gamma)
+
+    def sample(self, rng):
+        return float(np.exp(rng.uniform(*self.log_gamma)))
+
+    def _apply(self, image, gamma, rng):
+        output, buffer, _ = self._output(image)
+        low, up = float(buffer.min()), float(buffer.max())
+        if up > low:
+            buffer -= low
+            buffer /= up - low
+            np.power(buffer, gamma, out=buffer)
+            buffer *= up - low
+            buffer += low
+        return output
+
+
+class RandomNoise(RandomIntensityTransform):
+    '''
+        Adds gaussian noise of mean `mean` and a standard deviation drawn from `std`.
+    '''
+    def __init__(self, mean:float=0, std:Union[float, Tuple[float, float]]=(0, 0.25), p:float=1.,
+                 seed:int=None, transform_keys:Tuple[str]=None) -> None:
+        super().__init__(p, seed, transform_keys)
+        self.mean = mean
+        self.std = _range(std)
+
+    def sample(self, rng):
+        return float(rng.uniform(*self.std))
+
+    def _apply(self, image, std, rng):
+        output, buffer, _ = self._output(image)
+        noise = rng.standard_normal(buffer.shape, dtype=np.float32)
+        noise *= std
+        noise += self.mean
+        buffer += noise
+        return output
+
+
+class RandomBiasField(RandomIntensityTransform):
+    '''
+        Multiplies by exp(f), f a polynomial of degree `order` in the voxel coordinates
+        (normalized to [-1, 1]) with coefficients drawn from `coefficients`.
+    '''
+    def __init__(self, coefficients:Union[float, Tuple[float, float]]=0.5, order:int=3, p:float=1.,
+                 seed:int=None, transform_keys:Tuple[str]=None) -> None:
+        super().__init__(p, seed, transform_keys)
+        self.coefficients = _range(coefficients)
+        self.order = order
+
+    def sample(self, rng):
+        # the coefficients are drawn per image from this seed, so all images of a sample share them
+        return int(rng.integers(2**32))
+
+    def _apply(self, image, seed, rng):
+        output, buffer, _ = self._output(image)
+        shape = buffer.shape[:image.GetDimension()]
+        powers = [p for p in itertools.product(range(self.order + 1), repeat=len(shape)) if sum(p) <= self.order]
+        coefficients = np.random.default_rng(seed).uniform(*self.coefficients, size=len(powers))
+        # a sum of separable monomials, no full-size coordinate grids
+        field = np.zeros(shape, dtype=np.float32)
+        for coefficient, power in zip(coefficients, powers):
+            term = np.float32(coefficient)
+            for axis, exponent in enumerate(power):
+                axis_shape = [1] * len(shape)
+                axis_shape[axis] = -1
+                term = term * (np.linspace(-1, 1, shape[axis], dtype=np.float32) ** exponent).reshape(axis_shape)
+            field += term
+        np.exp(field, out=field)
+        buffer *= field if buffer.ndim == field.ndim else field[..., np.newaxis]
+        return output
+
+
+def fuse_random(plugins:List) -> List:
+    '''
+        Replaces every run of consecutive random spatial transforms by one `RandomSpatial`,
+        so a sample is resampled once.
+    '''
+    fused, run = [], []
+    for plugin in plugins + [None]:
+        fusable = isinstance(plugin, RandomSpatialTransform) and not isinstance(plugin, RandomSpatial)
+        if run and not (fusable and plugin.keys == run[0].keys):
+            fused.append(RandomSpatial(run, seed=run[0].seed, transform_keys=run[0].keys) if len(run) > 1 else run[0])
+            run = []
+        if fusable:
+            run.append(plugin)
+        elif plugin is not None:
+            fused.append(plugin)
+    return fused
@@ -1,13 +1,39 @@
+import threading
 import SimpleITK as sitk
 import numpy as np
-from typing import Sequence, Tuple, Union, overload
+from collections import OrderedDict
+from typing import List, Sequence, Tuple, Union, overload
 
 from data.image import Image, Subject
-from .utils import Transform, ResampleUtils, TransformFactory
+from .utils import Transform, ResampleUtils, worker_threads
+from . import geometry
 from config import TransformType, InterpolatorType, ImageType, PadType, KernelType
 
 
-class Pad(Transform):
+def _identity(dim:int) -> sitk.Transform:
+    return sitk.Transform(dim, TransformType.Identity)
+
+
+class GeometricTransform(Transform):
+    '''
+        A transform that only maps the input grid to an output grid (plus a spatial transform),
+        so that consecutive ones can be fused into one resampling pass (see `fuse_spatial`).
+        `interpolator` is None for exact steps and 'auto' for steps choosing it by image type.
+    '''
+    interpolator = None
+    default_value = None
+    cast = None
+    fusable = True
+
+    def geometry(self, grid:dict) -> Tuple[dict, sitk.Transform]:
+        '''
+            Returns the output grid for an input `grid` and the transform mapping output
+            physical points to input physical points.
+        '''
+        raise NotImplementedError
+
+
+class Pad(GeometricTransform):
     def __init__(self, mode:PadType, low:Tuple[int, int], up:Tuple[int, int],
                  pad_value=0, decay:float=1., transform_keys:Tuple[str]=None) -> None:
         super().__init__(transform_keys)
@@ -22,63 +48,248 @@ class Pad(Transform):
         pad_filter.SetPadLowerBound(low)
         pad_filter.SetPadUpperBound(up)
         self.total_filter.append(pad_filter)
+        self.low, self.up = np.asarray(low), np.asarray(up)
+        self.fusable = mode == PadType.PadConstant
+        self.default_value = pad_value
+
+    def geometry(self, grid):
+        return dict(
+            grid,
+            size=tuple(int(s) for s in np.add(grid['size'], self.low + self.up)),
+            origin=tuple(ResampleUtils.index_to_physical(grid, -self.low))
+        ), _identity(len(grid['size']))
 
 def pad(image:Union[sitk.Image, Image, Subject], mode:PadType, low:Tuple[int, int], up:Tuple[int, int],
         pad_value=0, decay:float=1., transform_keys:Tuple[str]=None):
     return Pad(mode, low, up, pad_value, decay, transform_keys)(image)
 
 
-class Crop(Transform):
+class Crop(GeometricTransform):
     def __init__(self, low:Tuple[int, int], up:Tuple[int, int], transform_keys:Tuple[str]=None) -> None:
         super().__init__(transform_keys)
         crop_filter = sitk.CropImageFilter()
         crop_filter.SetLowerBoundaryCropSize(low)
         crop_filter.SetUpperBoundaryCropSize(up)
         self.total_filter.append(crop_filter)
+        self.low, self.up = np.asarray(low), np.asarray(up)
+
+    def geometry(self, grid):
+        return dict(
+            grid,
+            size=tuple(int(s) for s in np.subtract(grid['size'], self.low + self.up)),
+            origin=tuple(ResampleUtils.index_to_physical(grid, self.low))
+        ), _identity(len(grid['size']))
 
 def crop(image:Union[sitk.Image, Image, Subject], low:Tuple[int, int], 
          up:Tuple[int, int], transform_keys:Tuple[str]=None):
     return Crop(low, up, transform_keys)(image)
 
 
-class Flip(Transform):
+def _box_corners(grid:dict, index:Sequence[int], size:Sequence[int]) -> np.ndarray:
+    # physical corners of the region the voxels of a box cover, not of their centres
+    return ResampleUtils.index_to_physical(grid, np.asarray(index) - 0.5 + geometry.corners({'size': size}))
+
+
+def _overlap(grid:dict, points:np.ndarray) -> Tuple[Tuple[int], Tuple[int]]:
+    # (index, size) of the voxels of `grid` overlapping the box of physical corners `points`
+    indexes = ResampleUtils.physical_to_index(grid, points)
+    lower = np.maximum(np.floor(indexes.min(axis=0) - 0.5 + 1e-3) + 1, 0).astype(int)
+    upper = np.minimum(np.ceil(indexes.max(axis=0) + 0.5 - 1e-3) - 1, np.asarray(grid['size']) - 1).astype(int)
+    if np.any(upper < lower):
+        raise ValueError("The foreground box does not overlap the image!")
+    return tuple(int(i) for i in lower), tuple(int(s) for s in upper - lower + 1)
+
+
+class CropToForeground(GeometricTransform):
+    '''
+        Crops to the bounding box, grown by `margin` voxels, of the foreground: the voxels
+        above `threshold` (e.g. the body in a CT) or, in a label map, the labels in `labels`
+        (any by default). On a Subject the box is found once on `mask_key` (the first image
+        by default) and every image is cropped to the voxels overlapping it in physical space,
+        so images on other grids get the same region; images not read yet only read the box.
+        The crop is recorded under `record_key` in the Subject so that results can be pasted
+        back into the original grid with `invert`. A single image has nowhere to keep it, use
+        `crop` to get the image with its record.
+    '''
+    fusable = False
+
+    def __init__(self, threshold:float=-500, labels:Sequence[int]=None, margin:Union[int, Sequence[int]]=0,
+                 mask_key:str=None, record_key:str='crop', transform_keys:Tuple[str]=None) -> None:
+        super().__init__(transform_keys)
+        self.threshold = threshold
+        self.labels = labels
+        self.margin = margin
+        self.mask_key = mask_key
+        self.record_key = record_key
+
+    def foreground(self, image:Union[sitk.Image, Image]) -> sitk.Image:
+        if getattr(image, 'type', ImageType.Scalar) != ImageType.Label:
+            return image > self.threshold
+        if self.labels is None:
+            return image != 0
+        view = image.view if isinstance(image, Image) else sitk.GetArrayViewFromImage(image)
+        mask = sitk.GetImageFromArray(np.isin(view, self.labels).view(np.uint8))
+        mask.CopyInformation(image)
+        return mask
+
+    def box(self, image:Union[sitk.Image, Image]) -> Tuple[Tuple[int], Tuple[int]]:
+        '''
+            (index, size) of the crop, the whole image when there is no foreground.
+        '''
+        dim = image.GetDimension()
+        statistics = sitk.LabelShapeStatisticsImageFilter()
+        statistics.ComputePerimeterOff()
+        statistics.Execute(self.foreground(image))
+        if not statistics.HasLabel(1):
+            return (0,) * dim, tuple(image.GetSize())
+        box = np.asarray(statistics.GetBoundingBox(1))
+        margin = np.broadcast_to(self.margin, (dim,)).astype(int)
+        lower = np.maximum(box[:dim] - margin, 0)
+        upper = np.minimum(box[:dim] + box[dim:] + margin, image.GetSize())
+        return tuple(int(i) for i in lower), tuple(int(s) for s in upper - lower)
+
+    def crop(self, image:Union[sitk.Image, Image]) -> Tuple[Image, dict]:
+        '''
+            The cropped image and its record, for `invert(result, record)`.
+        '''
+        image = image if isinstance(image, Image) else Image(image)
+        index, size = self.box(image)
+        return image.crop(index, size), {'grid': ResampleUtils.grid(image), 'index': index, 'size': size}
+
+    def __call__(self, image:Union[sitk.Image, Image, Subject]):
+        if not isinstance(image, Subject):
+            return self.crop(image)[0]
+        keys = tuple(image.images) if self.keys is None else self.keys
+        mask = image[self.mask_key or next(name for name in image.images if name in keys)]
+        index, size = self.box(mask)
+        grid = ResampleUtils.grid(mask)
+        points = _box_corners(grid, index, size)
+
+        def crop(value:Union[sitk.Image, Image]) -> Image:
+            value = value if isinstance(value, Image) else Image(value)
+            if ResampleUtils.grid_key(value) == ResampleUtils.grid_key(mask):
+                return value.crop(index, size)
+            return value.crop(*_overlap(ResampleUtils.grid(value), points))
+
+        subj = self._subject_apply(image, crop)
+        record = subj.get(self.record_key)
+        if record is None:
+            record = {'grid': grid, 'index': index, 'size': size}
+        else:
+            # crops stack up, the record stays relative to the very first grid (the new box is
+            # mapped into it, in case the images were resampled in between)
+            record = dict(record, **dict(zip(('index', 'size'), _overlap(record['grid'], points))))
+        subj[self.record_key] = record
+        return subj
+
+    @staticmethod
+    def invert(image:Union[sitk.Image, Image, Subject], record:dict=None, default_value:float=0,
+               record_key:str='crop') -> Union[Image, Subject]:
+        '''
+            Pastes a cropped image (or the images of a Subject and its record) back into the
+            original grid, filling the rest with `default_value`. Images still on the crop
+            grid are padded, others (e.g. resampled since) are resampled onto the original grid.
+        '''
+        if isinstance(image, Subject):
+            record = image[record_key] if record is None else record
+            subj = image.clone()
+            for name, value in image.images.items():
+                subj[name] = CropToForeground.invert(value, record, default_value)
+            del subj[record_key]
+            return subj
+
+        grid = record['grid']
+        type = getattr(image, 'type', ImageType.Scalar)
+        crop = dict(grid, size=tuple(record['size']),
+                    origin=tuple(ResampleUtils.index_to_physical(grid, np.asarray(record['index']))))
+        if tuple(image.GetSize()) == crop['size'] and np.allclose(image.GetSpacing(), crop['spacing']) and \
+                np.allclose(image.GetOrigin(), crop['origin'], atol=1e-4) and \
+                np.allclose(image.GetDirection(), crop['direction']):
+            upper = np.subtract(grid['size'], np.add(record['index'], record['size']))
+            return Image(sitk.ConstantPad(image, [int(i) for i in record['index']], [int(u) for u in upper],
+                                          default_value), type=type)
+        interpolator = InterpolatorType.NearestNeighbor if type == ImageType.Label else InterpolatorType.Linear
+        return Image(ResampleUtils.resample_filter(grid, _identity(image.GetDimension()), interpolator,
+                                                   default_value).Execute(image), type=type)
+
+
+class Flip(GeometricTransform):
     def __init__(self, axes:Sequence[bool], transform_keys:Tuple[str]=None) -> None:
         super().__init__(transform_keys)
         flip_filter = sitk.FlipImageFilter()
         flip_filter.SetFlipAxes(axes)
         self.total_filter.append(flip_filter)
+        self.axes = np.asarray(axes, dtype=bool)
+
+    def geometry(self, grid):
+        # the voxels are reversed but stay where they are in physical space
+        dim = len(grid['size'])
+        axes = self.axes[:dim]
+        direction = np.asarray(grid['direction']).reshape(dim, dim) * np.where(axes, -1, 1)
+        return dict(
+            grid,
+            origin=tuple(ResampleUtils.index_to_physical(grid, np.where(axes, np.asarray(grid['size']) - 1, 0))),
+            direction=tuple(direction.ravel())
+        ), _identity(dim)
 
 def flip(image:Union[sitk.Image, Image, Subject], axes:Sequence[bool], transform_keys:Tuple[str]=None):
     return Flip(axes, transform_keys)(image)
 
 
-class Resample(Transform):
+class Resample(GeometricTransform):
     @overload
     def __init__(self, transform:sitk.Transform, interpolator:InterpolatorType, 
-                 cast=None, transform_keys:Tuple[str]=None):
-        super().__init__(transform_keys)
-        resample_filter = self._get_base_resample_filter(transform, interpolator, cast)
-        self.total_filter.append(resample_filter)
+                 cast=None, transform_keys:Tuple[str]=None): ...
 
     @overload
     def __init__(self, transform:sitk.Transform, interpolator:InterpolatorType, reference:Union[Image, sitk.Image], 
-                 cast=None, transform_keys:Tuple[str]=None):
-        super().__init__(transform_keys)
-        resample_filter = self._get_base_resample_filter(transform, interpolator, cast)
-        resample_filter.SetReferenceImage(reference)
-        self.total_filter.append(resample_filter)
+                 cast=None, transform_keys:Tuple[str]=None): ...
 
     @overload
     def __init__(self, transform:sitk.Transform, interpolator:InterpolatorType, 
                  out_size:Sequence[int], out_spacing:Sequence[float], out_origin:Sequence[float], out_direction:Sequence[float],
-                 cast=None, transform_keys:Tuple[str]=None):
+                 cast=None, transform_keys:Tuple[str]=None): ...
+
+    def __init__(self, transform:sitk.Transform, interpolator:InterpolatorType, *args, **kwargs):
+        self.reference = self.out_grid = None
+        if args and isinstance(args[0], sitk.Image):
+            self.reference, args = ResampleUtils.grid(args[0]), args[1:]
+        elif len(args) >= 4 and not np.isscalar(args[0]):
+            size, spacing, origin, direction = args[:4]
+            self.out_grid = {
+                'size': tuple(size), 'spacing': tuple(spacing), 'origin': tuple(origin), 'direction': tuple(direction)
+            }
+            args = args[4:]
+        cast, transform_keys = (tuple(args) + (None, None))[:2]
+        cast, transform_keys = kwargs.get('cast', cast), kwargs.get('transform_keys', transform_keys)
+
         super().__init__(transform_keys)
-        resample_filter = self._get_base_resample_filter(transform, interpolator, cast)
-        resample_filter.SetSize(out_size)
-        resample_filter.SetOutputOrigin(out_origin)
-        resample_filter.SetOutputSpacing(out_spacing)
-        resample_filter.SetOutputDirection(out_direction)
-        self.total_filter.append(resample_filter)
+        self.transform = transform
+        self.interpolator = interpolator
+        self.cast = cast
+        self.default_value = 0
+        self.fusable = transform.IsLinear()
+        self.resample_filter = self._get_base_resample_filter(transform, interpolator, cast)
+        self.total_filter.append(self.resample_filter)
+
+    def __call__(self, image:Union[sitk.Image, Image, Subject]):
+        if self.reference is None and self.out_grid is None:
+            # without an output grid, every image is resampled onto its own grid
+            if isinstance(image, Subject):
+                return self._subject_apply(image, self._resample_on_input)
+            return self._resample_on_input(image)
+        return super().__call__(image)
+
+    def _resample_on_input(self, image:Union[sitk.Image, Image]):
+        # a filter per call, images of a Subject may be resampled concurrently
+        resample_filter = self._get_base_resample_filter(self.transform, self.interpolator, self.cast)
+        resample_filter.SetReferenceImage(image)
+        if worker_threads() is not None:
+            resample_filter.SetNumberOfThreads(worker_threads())
+        return Image(resample_filter.Execute(image), type=getattr(image, 'type', ImageType.Scalar))
+
+    def geometry(self, grid):
+        return dict(self.reference or self.out_grid or grid), self.transform
 
     def _get_base_resample_filter(self, transform, interpolator, cast):
         resample_filter = sitk.ResampleImageFilter()
@@ -86,27 +297,183 @@ class Resample(Transform):
         resample_filter.SetInterpolator(interpolator)
         if cast is not None:
             resample_filter.SetOutputPixelType(cast)
+        grid = self.reference or self.out_grid
+        if grid is not None:
+            resample_filter.SetSize(grid['size'])
+            resample_filter.SetOutputOrigin(grid['origin'])
+            resample_filter.SetOutputSpacing(grid['spacing'])
+            resample_filter.SetOutputDirection(grid['direction'])
         return resample_filter
 
 
-class Resize(Transform):
-    def __init__(self, target_size:Sequence[int], transform_keys: Tuple[str] = None) -> None:
+class Resize(GeometricTransform):
+    '''
+        Resamples images to `target_size`. The resample filter only depends on the input grid,
+        interpolator and thread count, so one plan is built per geometry and reused for every
+        image sharing it; at most `max_plans` plans are kept.
+    '''
+    interpolator = 'auto'
+
+    def __init__(self, target_size:Sequence[int], transform_keys: Tuple[str] = None, max_plans:int = 32) -> None:
         super().__init__(transform_keys)
         self.target_size = target_size
+        self.max_plans = max_plans
+        self._plans = OrderedDict()
+        self._lock = threading.Lock() # images of a Subject may be resized concurrently
 
     def __call__(self, image: Union[sitk.Image, Image, Subject]):
-        target_spacing = ResampleUtils.get_target_spacing(image, self.target_size)
-        interpolator = InterpolatorType.Linear if image.type == ImageType.Scalar else InterpolatorType.NearestNeighbor
-        
-        resample_filter = sitk.ResampleImageFilter()
-        resample_filter.SetTransform(TransformFactory.register(TransformType.Identity))
-        resample_filter.SetInterpolator(interpolator)
-        resample_filter.SetSize(self.target_size)
-        resample_filter.SetOutputSpacing(target_spacing)
-        resample_filter.SetOutputOrigin(image.GetOrigin())
-        resample_filter.SetOutputDirection(image.GetDirection())
-        self.total_filter.append(resample_filter)
-        return super().__call__(image)
+        if isinstance(image, Subject):
+            return self._subject_apply(image, self._resize)
+        return self._resize(image)
+
+    def _resize(self, image:Union[sitk.Image, Image]):
+        type = getattr(image, 'type', ImageType.Scalar)
+        return Image(self.plan(image).Execute(image), type=type)
+
+    def plan(self, image:Union[sitk.Image, Image]) -> sitk.ResampleImageFilter:
+        type = getattr(image, 'type', ImageType.Scalar)
+        interpolator = InterpolatorType.Linear if type == ImageType.Scalar else InterpolatorType.NearestNeighbor
+        # in a worker of the parallel executor, its share of the thread budget
+        threads = worker_threads() or sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+        key = ResampleUtils.grid_key(image) + (interpolator, threads)
+        with self._lock:
+            if key in self._plans:
+                self._plans.move_to_end(key)
+                return self._plans[key]
+
+            grid, _ = self.geometry(ResampleUtils.grid(image))
+            plan = ResampleUtils.resample_filter(grid, _identity(image.GetDimension()), interpolator)
+            plan.SetNumberOfThreads(threads)
+            self._plans[key] = plan
+            if len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+            return plan
+
+    def __getstate__(self):
+        # plans and the lock are rebuilt, e.g. in the worker processes of `run_batch`
+        return dict(self.__dict__, _plans=None, _lock=None)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, _plans=OrderedDict(), _lock=threading.Lock())
+
+    def geometry(self, grid):
+        spacing = np.asarray(grid['size']) * grid['spacing'] / np.asarray(self.target_size)
+        return dict(
+            grid, size=tuple(int(s) for s in self.target_size), spacing=tuple(spacing)
+        ), _identity(len(grid['size']))
+
+
+class FusedSpatial(Transform):
+    '''
+        Runs a chain of geometric transforms as one ResampleImageFilter: their transforms are
+        composed and only the last output grid is sampled. Voxels that an intermediate crop
+        would have discarded are set to the default value afterwards; when that region isn't
+        axis-aligned, the chain is run step by step instead.
+    '''
+    def __init__(self, steps:List[GeometricTransform], transform_keys:Tuple[str]=None) -> None:
+        super().__init__(transform_keys)
+        self.steps = steps
+        explicit = [step.interpolator for step in steps if step.interpolator not in (None, 'auto')]
+        if explicit:
+            self.interpolator = explicit[0]
+        else:
+            self.interpolator = 'auto' if any(step.interpolator == 'auto' for step in steps) else None
+        defaults = [step.default_value for step in steps if step.default_value is not None]
+        self.default_value = defaults[0] if defaults else 0
+        self.cast = steps[-1].cast
+
+    def __call__(self, image:Union[sitk.Image, Image, Subject]):
+        if isinstance(image, Subject):
+            return self._subject_apply(image, self._resample)
+        return self._resample(image)
+
+    def _interpolator(self, image:Union[sitk.Image, Image]):
+        if self.interpolator is None or getattr(image, 'type', ImageType.Scalar) == ImageType.Label and self.interpolator == 'auto':
+            return InterpolatorType.NearestNeighbor
+        return InterpolatorType.Linear if self.interpolator == 'auto' else self.interpolator
+
+    def _resample(self, image:Union[sitk.Image, Image]):
+        grids, transforms = [ResampleUtils.grid(image)], []
+        for step in self.steps:
+            grid, transform = step.geometry(grids[-1])
+            grids.append(grid)
+            transforms.append(transform)
+        box = self._valid_box(grids, transforms)
+        if box is None:
+            for step in self.steps:
+                image = step(image)
+            return image
+
+        grid = grids[-1]
+        resample_filter = ResampleUtils.resample_filter(
+            grid, sitk.CompositeTransform(transforms), self._interpolator(image), self.default_value, self.cast
+        )
+        output = Image(resample_filter.Execute(image), type=getattr(image, 'type', ImageType.Scalar))
+
+        lower, upper = box
+        for axis in range(len(lower)):
+            for start, stop in ((0, lower[axis]), (upper[axis] + 1, grid['size'][axis])):
+                if start < stop:
+                    index = [slice(None)] * len(lower)
+                    index[axis] = slice(int(start), int(stop))
+                    output[tuple(index)] = self.default_value
+        return output
+
+    @staticmethod
+    def _valid_box(grids:List[dict], transforms:List[sitk.Transform]):
+        '''
+            Box (lower, upper) of output indexes that lie inside every intermediate grid, or None
+            when one of them doesn't map to an axis-aligned box.
+        '''
+        grid = grids[-1]
+        dim = len(grid['size'])
+        lower, upper = np.zeros(dim), np.asarray(grid['size']) - 1.
+        basis = np.vstack([np.zeros(dim), np.eye(dim)])
+        for k in range(1, len(grids) - 1):
+            composite = sitk.CompositeTransform(transforms[k:])
+            points = geometry.transform_points(composite, ResampleUtils.index_to_physical(grid, basis))
+            indexes = ResampleUtils.physical_to_index(grids[k], points)
+            offset, matrix = indexes[0], (indexes[1:] - indexes[0]).T
+            bounds = np.stack([-0.5 - offset, np.asarray(grids[k]['size']) - 0.5 - offset])
+            corners = offset + np.stack([lower, upper]) @ matrix.T
+            if np.all(corners >= bounds[0] - 1e-6) and np.all(corners <= bounds[1] + 1e-6):
+                continue
+            nonzero = np.abs(matrix) > 1e-9 * np.abs(matrix).max()
+            if np.any(nonzero.sum(axis=1) != 1):
+                return None
+            for i, j in zip(*np.nonzero(nonzero)):
+                lo, hi = sorted(bounds[:, i] / matrix[i, j])
+                lower[j] = max(lower[j], np.ceil(lo - 1e-6))
+                upper[j] = min(upper[j], np.floor(hi + 1e-6))
+        return lower.astype(int), upper.astype(int)
+
+
+def _fusable_with(run:List[GeometricTransform], plugin:GeometricTransform) -> bool:
+    defaults = {step.default_value for step in run + [plugin] if step.default_value is not None}
+    explicit = {step.interpolator for step in run + [plugin] if step.interpolator not in (None, 'auto')}
+    # an interpolating step after a pad blends the border with the pad value, which the fused
+    # resampling would take from outside of the image instead
+    padded = plugin.interpolator is not None and any(isinstance(step, Pad) for step in run)
+    return plugin.keys == run[0].keys and run[-1].cast is None and len(defaults) <= 1 and len(explicit) <= 1 \
+        and not padded
+
+
+def fuse_spatial(plugins:List) -> List:
+    '''
+        Replaces every run of consecutive fusable geometric transforms by one `FusedSpatial`.
+        Anything else (intensity filters, morphology, mirror pads, ...) ends a run.
+    '''
+    fused, run = [], []
+    for plugin in plugins + [None]:
+        fusable = isinstance(plugin, GeometricTransform) and plugin.fusable
+        if run and not (fusable and _fusable_with(run, plugin)):
+            fused.append(FusedSpatial(run, run[0].keys) if len(run) > 1 else run[0])
+            run = []
+        if fusable:
+            run.append(plugin)
+        elif plugin is not None:
+            fused.append(plugin)
+    return fused
 
 
 class BinaryMorphologicalOpen(Transform):
@@ -222,4 +589,105 @@ class ObjectMorphologicalDilate(Transform):
         dilate_filter.SetObjectValue(object_value)
         dilate_filter.SetKernelRadius(radius)
         dilate_filter.SetKernelType(kernel)
-        self.total_filter.append(dilate_filter)
\ No newline at end of file
+        self.total_filter.append(dilate_filter)
+
+class LabelMorphology(Transform):
+    '''
+        Morphology of every label of a label map in one pass: each label (or those in
+        `labels`) is processed on its bounding box grown by the kernel radius instead of on
+        the whole volume. Labels only grow into background, never into another label; a
+        background voxel claimed by several labels goes to the nearest one (in physical
+        distance, the lowest label on ties). `radius` is in voxels.
+    '''
+    operation = None
+
+    def __init__(self, radius:Union[int, Sequence[int]], kernel=KernelType.Ball, labels:Sequence[int]=None,
+                 background:int = 0, transform_keys: Tuple[str] = None) -> None:
+        super().__init__(transform_keys)
+        self.radius = radius
+        self.kernel = kernel
+        self.labels = labels
+        self.background = background
+
+    @property
+    def grows(self) -> bool:
+        return self.operation in ('dilate', 'close')
+
+    @property
+    def halo(self) -> int:
+        # slices on each side a z-slab needs (see `transform.stream`)
+        radius = np.ravel(self.radius)
+        return (2 if self.operation in ('open', 'close') else 1) * int(radius[2] if len(radius) > 2 else radius[-1])
+
+    def _filter(self) -> sitk.ImageFilter:
+        morphology_filter = {
+            'erode': sitk.BinaryErodeImageFilter, 'dilate': sitk.BinaryDilateImageFilter,
+            'open': sitk.BinaryMorphologicalOpeningImageFilter, 'close': sitk.BinaryMorphologicalClosingImageFilter,
+        }[self.operation]()
+        morphology_filter.SetForegroundValue(1)
+        morphology_filter.SetKernelRadius(self.radius)
+        morphology_filter.SetKernelType(self.kernel)
+        return morphology_filter
+
+    def __call__(self, image:Union[sitk.Image, Image, Subject]):
+        if isinstance(image, Subject):
+            return self._subject_apply(image, self._apply)
+        return self._apply(image)
+
+    def _apply(self, image:Union[sitk.Image, Image]):
+        view = image.view if isinstance(image, Image) else sitk.GetArrayViewFromImage(image)
+        if view.dtype.kind not in 'iu':
+            raise ValueError("Label morphology needs an integer label map!")
+        statistics = sitk.LabelShapeStatisticsImageFilter()
+        statistics.SetBackgroundValue(self.background)
+        statistics.ComputePerimeterOff()
+        statistics.Execute(image)
+        labels = statistics.GetLabels() if self.labels is None else \
+            sorted(set(statistics.GetLabels()) & set(self.labels))
+
+        output = Image(sitk.Image(image.GetSize(), image.GetPixelID()), type=getattr(image, 'type', ImageType.Label))
+        output.CopyInformation(image)
+        out = output.buffer()
+        out[...] = view
+        dim = image.GetDimension()
+        # a closed label reaches one radius out, its closing looks one more radius beyond
+        pad = (2 if self.operation == 'close' else 1) * np.broadcast_to(self.radius, (dim,)).astype(int)
+        distance = np.full(view.shape, np.inf, dtype=np.float32) if self.grows else None
+        morphology_filter = self._filter()
+
+        for label in sorted(labels):
+            box = statistics.GetBoundingBox(label)
+            lower = np.maximum(np.asarray(box[:dim]) - pad, 0)
+            upper = np.minimum(np.asarray(box[:dim]) + box[dim:] + pad, image.GetSize())
+            region = tuple(slice(low, up) for low, up in zip(lower[::-1], upper[::-1]))
+            mask = view[region] == label
+            crop = sitk.GetImageFromArray(mask.view(np.uint8))
+            crop.SetSpacing(image.GetSpacing())
+            result = sitk.GetArrayFromImage(morphology_filter.Execute(crop)).astype(bool)
+            if not self.grows:
+                out[region][mask & ~result] = self.background
+                continue
+            # squared distance to the label, positive outside of it
+            gap = sitk.GetArrayFromImage(sitk.SignedMaurerDistanceMap(
+                crop, insideIsPositive=False, squaredDistance=True, useImageSpacing=True
+            ))
+            claim = result & ~mask & (view[region] == self.background) & (gap < distance[region])
+            out[region][claim] = label
+            distance[region][claim] = gap[claim]
+        return output
+
+
+class LabelMorphologicalErode(LabelMorphology):
+    operation = 'erode'
+
+
+class LabelMorphologicalDilate(LabelMorphology):
+    operation = 'dilate'
+
+
+class LabelMorphologicalOpen(LabelMorphology):
+    operation = 'open'
+
+
+class LabelMorphologicalClose(LabelMorphology):
+    operation = 'close'
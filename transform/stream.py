@@ -0,0 +1,190 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Sequence, Union
+import SimpleITK as sitk
+import numpy as np
+
+from data import io
+from data.image import Image
+from data.chunked import ChunkedWriter
+from config import numpy_dtypes
+from .utils import Composite, Transform
+from .spatial import GeometricTransform, FusedSpatial
+from .intensity import IntensityTransform, FusedIntensity, _Statistics, _integer_histogram
+from .random import RandomTransform
+from .graph import voxelwise
+
+
+# filters with a kernel getter whose output still depends on the whole image
+_NOT_LOCAL = {'CannyEdgeDetectionImageFilter'}
+
+
+def plugin_halo(plugin:Any, spacing:float) -> int:
+    '''
+        Number of slices on each side of a z-slab a plugin needs to get the slab right, from
+        its kernel radius or smoothing sigma (`spacing` is the z spacing). Plugins can set a
+        `halo` attribute. Filters that are neither voxel-wise (see `graph.voxelwise`) nor of
+        a known kernel size may depend on the whole image and raise ValueError.
+    '''
+    if hasattr(plugin, 'halo'):
+        return int(plugin.halo)
+    if isinstance(plugin, Composite):
+        return sum(plugin_halo(step, spacing) for step in plugin.composite)
+    if isinstance(plugin, (FusedIntensity, IntensityTransform)) or voxelwise(plugin):
+        return 0
+    if isinstance(plugin, Transform):
+        return plugin_halo(plugin.total_filter, spacing)
+    if not isinstance(plugin, sitk.ImageFilter) or type(plugin).__name__ in _NOT_LOCAL:
+        raise ValueError(f"{_name(plugin)} may depend on the whole image and can't be run by slabs, "
+                         f"give it a `halo` if it doesn't!")
+    for getter in ('GetKernelRadius', 'GetRadius'):
+        if hasattr(plugin, getter):
+            radius = np.ravel(getattr(plugin, getter)())
+            radius = int(radius[2] if len(radius) > 2 else radius[-1])
+            # an opening or closing is an erosion and a dilation in a row
+            return 2 * radius if 'Opening' in plugin.GetName() or 'Closing' in plugin.GetName() else radius
+    if hasattr(plugin, 'GetSigma'):
+        # recursive smoothing has an infinite response, 6 sigmas bring the seams under 1e-5
+        sigma = np.ravel(plugin.GetSigma())
+        return int(np.ceil(6 * (sigma[2] if len(sigma) > 2 else sigma[-1]) / spacing))
+    if hasattr(plugin, 'GetVariance'):
+        variance = np.ravel(plugin.GetVariance())
+        sigma = np.sqrt(variance[2] if len(variance) > 2 else variance[-1])
+        return int(np.ceil(4 * sigma / (spacing if plugin.GetUseImageSpacing() else 1)))
+    raise ValueError(f"{_name(plugin)} may depend on the whole image and can't be run by slabs, "
+                     f"give it a `halo` if it doesn't!")
+
+
+def _name(plugin:Any) -> str:
+    return plugin.GetName() if isinstance(plugin, sitk.ImageFilter) else type(plugin).__name__
+
+
+def _check(plugin:Any):
+    if isinstance(plugin, (GeometricTransform, FusedSpatial)):
+        raise ValueError(f"{type(plugin).__name__} changes the voxel grid and can't be run by slabs!")
+    if isinstance(plugin, RandomTransform):
+        raise ValueError(f"{type(plugin).__name__} is random and can't be run by slabs!")
+    if isinstance(plugin, Composite):
+        for step in plugin.composite:
+            _check(step)
+    else:
+        plugin_halo(plugin, 1.) # raises for steps that may depend on the whole image
+
+
+def _read_slab(header:dict, start:int, stop:int) -> Image:
+    size = tuple(header['size'])
+    return Image(io.imread_from_header(io.crop_header(header, (0, 0, start), size[:2] + (stop - start,))))
+
+
+def volume_statistics(header:dict, slab:int, bins:int=2**16) -> _Statistics:
+    '''
+        Statistics of a whole volume gathered slab by slab: an exact histogram for integer
+        voxels, a `bins` bins histogram (approximate percentiles and moments) otherwise.
+    '''
+    depth = header['size'][2]
+    slabs = [(start, min(start + slab, depth)) for start in range(0, depth, slab)]
+    if np.dtype(numpy_dtypes[header['pixel_id']]).kind in 'iu':
+        counts = {}
+        for start, stop in slabs:
+            histogram = _integer_histogram(_read_slab(header, start, stop).view)
+            if histogram is None:
+                break
+            for value, count in zip(*histogram):
+                counts[value] = counts.get(value, 0) + count
+        else:
+            values = np.asarray(sorted(counts))
+            return _Statistics.from_histogram(values, np.asarray([counts[value] for value in values]))
+
+    low, up = np.inf, -np.inf
+    for start, stop in slabs:
+        view = _read_slab(header, start, stop).view
+        low, up = min(low, float(view.min())), max(up, float(view.max()))
+    counts = np.zeros(bins, dtype=np.int64)
+    for start, stop in slabs:
+        counts += np.histogram(_read_slab(header, start, stop).view, bins, (low, up))[0]
+    values = np.linspace(low, up, bins + 1)
+    values = (values[:-1] + values[1:]) / 2
+    values[0], values[-1] = low, up # keep the exact range
+    return _Statistics.from_histogram(values[counts > 0], counts[counts > 0])
+
+
+def _steps(plugin:Any) -> List[IntensityTransform]:
+    if isinstance(plugin, FusedIntensity):
+        return plugin.steps
+    return [plugin] if isinstance(plugin, IntensityTransform) else None
+
+
+def _prepare(pipeline:Union[Composite, Transform], header:dict, slab:int) -> List[Any]:
+    plugins = list(pipeline.composite) if isinstance(pipeline, Composite) else [pipeline]
+    for plugin in plugins:
+        _check(plugin)
+    # the leading intensity steps, up to the last one needing statistics, are fused and given
+    # those of the whole volume; the rest runs as written
+    leading = 0
+    while leading < len(plugins) and _steps(plugins[leading]) is not None \
+            and plugins[leading].keys == plugins[0].keys:
+        leading += 1
+    needing = [index for index, plugin in enumerate(plugins)
+               if _steps(plugin) is not None and not all(step.local for step in _steps(plugin))]
+    if not needing:
+        return plugins
+    if needing[-1] >= leading or header['channels'] > 1:
+        raise ValueError(f"{type(plugins[needing[-1]]).__name__} needs whole-volume statistics, it can only be "
+                         f"run by slabs after intensity steps only, on a scalar image!")
+    steps = [step for plugin in plugins[:needing[-1] + 1] for step in _steps(plugin)]
+    fused = FusedIntensity(steps, plugins[0].keys, statistics=volume_statistics(header, slab))
+    return [fused] + plugins[needing[-1] + 1:]
+
+
+def stream(
+    pipeline:Union[Composite, Transform],
+    source:str,
+    output:str,
+    slab:int = 64,
+    workers:int = 1,
+    halo:int = None,
+    chunks:Sequence[int] = (64, 64, 64),
+    compression:str = None,
+    level:int = 1
+) -> Image:
+    '''
+        Runs `pipeline` over the image at `source` by z-slabs of `slab` slices, each read
+        with a halo of the slices its filters need (see `plugin_halo`, or `halo`), and writes
+        the result into the chunked volume `output` (.mxv). Peak memory is `workers` slabs
+        instead of the whole volume. Steps changing the voxel grid can't be streamed;
+        Rescale/Normalize can only follow other intensity steps, and get statistics of the
+        whole volume. The output matches the one of `pipeline` run on the whole image (up to
+        the binned statistics of a float volume, see `volume_statistics`).
+        Returns the output as a lazy Image.
+    '''
+    header = io.imread_header(source)
+    if len(header['size']) != 3:
+        raise ValueError("Only 3D volumes can be run by slabs!")
+    plugins = _prepare(pipeline, header, slab)
+    halo = sum(plugin_halo(plugin, header['spacing'][2]) for plugin in plugins) if halo is None else halo
+    depth = header['size'][2]
+    if compression is not None:
+        slab = max(slab // chunks[0], 1) * chunks[0] # compressed slabs are written as whole chunks
+    composite = Composite(plugins)
+
+    def run(start:int):
+        stop = min(start + slab, depth)
+        lower, upper = max(start - halo, 0), min(stop + halo, depth)
+        result = composite(_read_slab(header, lower, upper))
+        return start, np.asarray(result.view[start - lower:stop - lower]), result
+
+    start, array, result = run(0)
+    writer = ChunkedWriter(
+        output, (depth,) + array.shape[1:], array.dtype, {
+            'spacing': header['spacing'], 'origin': header['origin'], 'direction': header['direction'],
+            'pixel_id': result.GetPixelID(), 'channels': result.GetNumberOfComponentsPerPixel(), 'metadata': {},
+        }, chunks, compression, level
+    )
+    writer.write(start, array)
+
+    def run_and_write(start:int):
+        writer.write(*run(start)[:2])
+
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(run_and_write, range(slab, depth, slab)))
+    writer.close()
+    return Image(output)
@@ -1,14 +1,124 @@
+import os
+import time
+import pickle
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import SimpleITK as sitk
 import numpy as np
-from typing import Any, Callable, List, Sequence, Union, Tuple
+from typing import Any, Callable, List, Optional, Sequence, Union, Tuple
 
 from data.image import Image, Subject
-from config import TransformType
+from . import geometry
+from config import TransformType, ImageType
+
+
+_IGNORED_PROPERTIES = ('Debug', 'NumberOfThreads', 'NumberOfWorkUnits')
+
+
+def _rebuild_filter(name:str, properties:dict) -> sitk.ImageFilter:
+    image_filter = getattr(sitk, name)()
+    for key, value in properties.items():
+        getattr(image_filter, 'Set' + key)(value)
+    return image_filter
+
+
+def _reduce_filter(image_filter:sitk.ImageFilter):
+    # SimpleITK filters can't be pickled, they are rebuilt from their Get/Set properties
+    properties = {}
+    for name in dir(image_filter):
+        key = name[3:]
+        if name.startswith('Get') and not name.startswith('GetGlobal') and key not in _IGNORED_PROPERTIES \
+                and hasattr(image_filter, 'Set' + key):
+            value = getattr(image_filter, name)()
+            properties[key] = dict(value) if hasattr(value, 'keys') else value
+    return _rebuild_filter, (type(image_filter).__name__, properties)
+
+
+class _FilterPickler(pickle.Pickler):
+    # reduces filters for this pickler only, pickling elsewhere in the process is left alone
+    def reducer_override(self, obj):
+        if isinstance(obj, sitk.ImageFilter):
+            return _reduce_filter(obj)
+        return NotImplemented
+
+
+def dumps(obj:Any) -> bytes:
+    '''
+        Pickles a pipeline holding SimpleITK filters, e.g. for worker processes; `pickle.loads`
+        rebuilds it.
+    '''
+    buffer = BytesIO()
+    _FilterPickler(buffer, pickle.HIGHEST_PROTOCOL).dump(obj)
+    return buffer.getvalue()
+
+
+executor:ThreadPoolExecutor = None
+workers = 1
+thread_budget = 1
+_default_threads = None
+_worker = threading.local()
+
+
+def enable_parallel(max_workers:int=None, threads:int=None) -> ThreadPoolExecutor:
+    '''
+        Makes transforms process the images of a Subject concurrently on `max_workers` threads,
+        sharing a budget of `threads` (all cores by default) between them: every filter runs
+        on its share of the budget instead of on all cores.
+    '''
+    global executor, workers, thread_budget, _default_threads
+    disable_parallel()
+    thread_budget = threads or os.cpu_count() or 1
+    workers = max_workers or thread_budget
+    executor = ThreadPoolExecutor(workers)
+    _default_threads = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+    # filters created from now on (resample plans, fused resamplings) get one worker's share
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(max(1, thread_budget // workers))
+    return executor
+
+
+def disable_parallel():
+    global executor, workers, thread_budget
+    if executor is not None:
+        executor.shutdown()
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(_default_threads)
+    executor, workers, thread_budget = None, 1, 1
+
+
+def _run_in_worker(call:Callable, image:Union[sitk.Image, Image], threads:int):
+    # a transform called inside a worker runs serially, the pool can't wait on itself
+    _worker.active, _worker.threads = True, threads
+    try:
+        return call(image)
+    finally:
+        _worker.active, _worker.threads = False, None
+
+
+def worker_threads() -> Optional[int]:
+    '''
+        Threads a filter gets inside a worker of the parallel executor, None outside one.
+    '''
+    return getattr(_worker, 'threads', None)
+
+
+def copy_filter(image_filter:sitk.ImageFilter) -> sitk.ImageFilter:
+    return _rebuild_filter(*_reduce_filter(image_filter)[1])
 
 
 class Composite:
-    def __init__(self, composite:List[Any]) -> None:
+    '''
+        Runs its plugins in order. With a `TransformCache` (transform/cache.py), the output of
+        the last deterministic step (and of the steps the cache is told to keep) is stored on
+        disk and a later run over the same input resumes from the last step whose output is cached. With a `Profiler` (transform/profile.py),
+        time and memory of every step are recorded. A `lazy` Composite returns a `Deferred`
+        (transform/graph.py) instead of running: the steps are optimized as a whole and run on
+        `compute()`.
+    '''
+    def __init__(self, composite:List[Any], cache=None, profiler=None, lazy:bool=False) -> None:
         self.composite = composite
+        self.cache = cache
+        self.profiler = profiler
+        self.lazy = lazy
 
     def append(self, plugin):
         self.composite.append(plugin)
@@ -25,16 +135,94 @@ class Composite:
     def __getitem__(self, index):
         return self.composite[index]
 
+    def fuse(self):
+        '''
+            Returns a Composite in which runs of consecutive geometric transforms (Flip, Crop,
+            constant Pad, Resize, Resample) are folded into one resampling pass, and runs of
+            intensity transforms (Clip, Rescale, Normalize) into one pass over the voxels.
+            Consecutive random spatial augmentations are composed into one resampling too.
+
+            Fused output matches the step-by-step one up to float rounding, casts included: a
+            fused intensity run still rounds into an integer pixel type where the steps would
+            (see `FusedIntensity`). The exception is an interpolating step after a crop, which
+            reads the neighbours beyond the crop, so the outermost voxels can differ slightly.
+            A constant pad ends a run before an interpolating step for that reason.
+        '''
+        from .spatial import fuse_spatial
+        from .intensity import fuse_intensity
+        from .random import fuse_random
+        return Composite(fuse_intensity(fuse_spatial(fuse_random(self.composite))), self.cache, self.profiler, self.lazy)
+
+    def map(self, inputs:Sequence[Union[str, dict, Subject]], output:Union[str, Callable]=None,
+            processes:int=None, manifest:str=None, **kwargs) -> List[dict]:
+        '''
+            Runs the pipeline over a cohort on a process pool, see `transform.batch.run_batch`.
+        '''
+        from .batch import run_batch
+        return run_batch(self, inputs, output, processes, manifest, **kwargs)
+
+    def stream(self, source:str, output:str, slab:int=64, workers:int=1, **kwargs) -> Image:
+        '''
+            Runs the pipeline over a volume on disk by z-slabs into a chunked volume, see
+            `transform.stream.stream`.
+        '''
+        from .stream import stream
+        return stream(self, source, output, slab, workers, **kwargs)
+
     def __call__(self, image:Union[sitk.Image, Image, Subject]):
-        for plugin in self.composite:
-            if isinstance(plugin, sitk.ImageFilter):
-                image = plugin.Execute(image)
+        from .graph import Deferred
+        if isinstance(image, Deferred):
+            if self.lazy:
+                return image.then(self.composite, self.cache, self.profiler)
+            image = image.compute()
+        elif self.lazy:
+            return Deferred(image, list(self.composite), self.cache, self.profiler)
+        type = getattr(image, 'type', ImageType.Scalar)
+        start, stored = 0, ()
+        if self.cache is not None and len(self.composite):
+            lookup = time.perf_counter()
+            keys = self.cache.keys(image, self.composite)
+            stored = self.cache.stored(keys)
+            start, output = self.cache.lookup(keys, image)
+            image = image if output is None else output
+            if self.profiler is not None:
+                self.profiler.record(-1, 'TransformCache', lookup, time.perf_counter() - lookup, 0.)
+        for step, plugin in enumerate(self.composite[start:], start + 1):
+            if self.profiler is None:
+                image = self._run(plugin, image)
             else:
-                image = plugin(image)
-        return Image(image)
+                image = self.profiler.run(step - 1, plugin, self._run, image)
+            if step in stored:
+                if not isinstance(image, (Image, Subject)):
+                    image = Image(image, type=type)
+                self.cache.store(keys[step], image)
+        return image if isinstance(image, (Image, Subject)) else Image(image, type=type)
+
+    @staticmethod
+    def _run(plugin, image:Union[sitk.Image, Image, Subject]):
+        if isinstance(plugin, sitk.ImageFilter) and isinstance(image, Subject):
+            image = image.clone()
+            image.update({
+                name: Image(plugin.Execute(value), type=getattr(value, 'type', ImageType.Scalar))
+                for name, value in image.images.items()
+            })
+            return image
+        if isinstance(plugin, sitk.ImageFilter):
+            if worker_threads() is not None:
+                # other workers may run the same filter at once, this one runs a copy on its share
+                plugin = copy_filter(plugin)
+                plugin.SetNumberOfThreads(worker_threads())
+            return plugin.Execute(image)
+        return plugin(image)
 
 
 class Transform:
+    def __new__(cls, *args, **kwargs):
+        # the constructor arguments define the transform, e.g. in cache keys (transform/cache.py)
+        transform = super().__new__(cls)
+        transform._arguments = (args, kwargs)
+        return transform
+
     def __init__(self, transform_keys:Tuple[str]=None) -> None:
         self.total_filter = Composite([])
         self.keys = transform_keys
@@ -48,13 +236,25 @@ class Transform:
         else:
             raise ValueError("You don't give filters!")
  
+    def stream(self, source:str, output:str, slab:int=64, workers:int=1, **kwargs) -> Image:
+        from .stream import stream
+        return stream(self, source, output, slab, workers, **kwargs)
+
     def _subject_apply(self, subj:Subject, apply:Callable=None):
         subj_ = subj.clone()
         keys = tuple(subj.keys()) if self.keys is None else self.keys
         call = self.total_filter if apply is None else apply
-        for name, value in subj_.images.items():
-            if name in keys:
-                subj_[name] = call(value)
+        names = [name for name in subj_.images if name in keys]
+        if executor is None or len(names) < 2 or getattr(_worker, 'active', False):
+            for name in names:
+                subj_[name] = call(subj_[name])
+            return subj_
+
+        # every image gets its share of the thread budget, passed to the filters it runs
+        threads = max(1, thread_budget // min(len(names), workers))
+        futures = {name: executor.submit(_run_in_worker, call, subj_[name], threads) for name in names}
+        for name, future in futures.items():
+            subj_[name] = future.result()
         return subj_
 
 
@@ -84,59 +284,64 @@ class TransformFactory:
 
 
 class ResampleUtils:
+    @staticmethod
+    def grid(image:Union[Image, sitk.Image]) -> dict:
+        return {
+            'size': tuple(image.GetSize()),
+            'spacing': tuple(image.GetSpacing()),
+            'origin': tuple(image.GetOrigin()),
+            'direction': tuple(image.GetDirection()),
+        }
+
+    @staticmethod
+    def grid_key(image:Union[Image, sitk.Image]) -> tuple:
+        return tuple(image.GetSize()) + tuple(image.GetSpacing()) + tuple(image.GetOrigin()) + tuple(image.GetDirection())
+
+    @staticmethod
+    def resample_filter(grid:dict, transform:sitk.Transform, interpolator:int,
+                        default_value:float=0, cast:int=None) -> sitk.ResampleImageFilter:
+        resample_filter = sitk.ResampleImageFilter()
+        resample_filter.SetSize([int(s) for s in grid['size']])
+        resample_filter.SetOutputSpacing(grid['spacing'])
+        resample_filter.SetOutputOrigin(grid['origin'])
+        resample_filter.SetOutputDirection(grid['direction'])
+        resample_filter.SetTransform(transform)
+        resample_filter.SetInterpolator(interpolator)
+        resample_filter.SetDefaultPixelValue(default_value)
+        if cast is not None:
+            resample_filter.SetOutputPixelType(cast)
+        return resample_filter
+
+    @staticmethod
+    def index_to_physical(grid:dict, index:np.ndarray) -> np.ndarray:
+        return geometry.index_to_physical(grid, index)
+
+    @staticmethod
+    def physical_to_index(grid:dict, points:np.ndarray) -> np.ndarray:
+        return geometry.physical_to_index(grid, points)
+
     @staticmethod
     def get_grid_size(image:Union[Image, sitk.Image], transform:sitk.Transform):
-        transformed_extreme_points = ResampleUtils.get_transformed_extreme_points(image, transform)
-        min_x = min(transformed_extreme_points)[0]
-        min_y = min(transformed_extreme_points, key=lambda p: p[1])[1]
-        max_x = max(transformed_extreme_points)[0]
-        max_y = max(transformed_extreme_points, key=lambda p: p[1])[1]
-        if image.GetDimension() == 2:
-            return {
-                'size': [
-                    int((max_x - min_x) / image.GetSpacing()[0]),
-                    int((max_y - min_y) / image.GetSpacing()[1])
-                ],
-                'origin': np.asarray([min_x, min_y])
-            }
-        elif image.GetDimension() == 3:
-            min_z = min(transformed_extreme_points, key=lambda p: p[2])[2]
-            max_z = max(transformed_extreme_points, key=lambda p: p[2])[2]
-            return {
-                'size': [
-                    int((max_x - min_x) / image.GetSpacing()[0]),
-                    int((max_y - min_y) / image.GetSpacing()[1]),
-                    int((max_z - min_z) / image.GetSpacing()[2])
-                ],
-                'origin': np.asarray([min_x, min_y, min_z])
-            }
+        '''
+            Size and origin of the axis-aligned grid bounding `image` resampled by `transform`;
+            see `geometry.output_grids` for many transforms at once.
+        '''
+        sizes, origins = geometry.output_grids(ResampleUtils.grid(image), [transform])
+        return {'size': [int(s) for s in sizes[0]], 'origin': origins[0]}
 
     @staticmethod
     def get_extreme_points(image:Union[Image, sitk.Image]):
-        if image.GetDimension() == 2:
-            return [
-                image.TransformIndexToPhysicalPoint((0, 0)),
-                image.TransformIndexToPhysicalPoint((image.GetWidth(), 0)),
-                image.TransformIndexToPhysicalPoint((image.GetWidth(), image.GetHeight())),
-                image.TransformIndexToPhysicalPoint((0, image.GetHeight())),
-            ]
-        elif image.GetDimension() == 3:
-            return [
-                image.TransformIndexToPhysicalPoint((0, 0, 0)),
-                image.TransformIndexToPhysicalPoint((image.GetWidth(), 0, 0)),
-                image.TransformIndexToPhysicalPoint((image.GetWidth(), image.GetHeight(), 0)),
-                image.TransformIndexToPhysicalPoint((image.GetWidth(), image.GetHeight(), image.GetDepth())),
-                image.TransformIndexToPhysicalPoint((0, image.GetHeight(), 0)),
-                image.TransformIndexToPhysicalPoint((0, image.GetHeight(), image.GetDepth())),
-                image.TransformIndexToPhysicalPoint((image.GetWidth(), 0, image.GetDepth())),
-                image.TransformIndexToPhysicalPoint((0, 0, image.GetDepth())),
-            ]
+        grid = ResampleUtils.grid(image)
+        return [tuple(point) for point in geometry.index_to_physical(grid, geometry.corners(grid))]
 
     @staticmethod
     def get_transformed_extreme_points(image:Union[Image, sitk.Image], transform:sitk.Transform):
-        extreme_points = ResampleUtils.get_extreme_points(image)
-        inverse_transform:sitk.Transform = transform.GetInverse()
-        return [inverse_transform.TransformPoint(p) for p in extreme_points]
+        grid = ResampleUtils.grid(image)
+        points = geometry.index_to_physical(grid, geometry.corners(grid))
+        matrix = geometry.affine_matrix(transform, image.GetDimension())
+        if matrix is None:
+            return [tuple(point) for point in geometry.transform_points(transform.GetInverse(), points)]
+        return [tuple(point) for point in geometry.apply_affine(np.linalg.inv(matrix), points)]
 
     @staticmethod
     def get_target_size(image:Union[Image, sitk.Image], target_spacing:Sequence[float]):